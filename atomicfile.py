@@ -0,0 +1,20 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from marshal import loads as marshal_loads
+from os import replace, getpid
+
+def atomic_write(path, data):
+    # readers see either the old or the new contents, never a partial file
+    tmp = "{}.{}.tmp".format(path, getpid())
+    with open(tmp, "wb") as s:
+        s.write(data)
+    replace(tmp, path)
+
+def atomic_load(path, default=None, loads=marshal_loads):
+    # a missing or damaged file is the same as no file
+    try:
+        with open(path, "rb") as s:
+            return loads(s.read())
+    except Exception:
+        return default
@@ -0,0 +1,108 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from argparse import ArgumentParser
+from gc import collect
+from io import StringIO
+from os import remove
+from shutil import rmtree
+from random import Random
+from tempfile import mkstemp, mkdtemp
+from time import perf_counter
+from vdf import load, load_stream, dump
+from kvcache import KVCache
+
+def generate_items_game(size):
+    r = Random(0)
+    heroes = ["axe", "lina", "tiny", "techies", "terrorblade", "crystal_maiden"]
+    slots = ["weapon", "head", "back", "shoulder", "arms", "belt"]
+    types = ["particle", "sound", "activity", "entity_model", "icon_replacement"]
+    s = StringIO()
+    s.write('"items_game"\n{\n\t"game_info"\n\t{\n\t\t"first_valid_class"\t\t"2"\n\t}\n')
+    s.write('\t// generated for bench_vdf.py\n\t"prefabs"\n\t{\n')
+    for slot in slots:
+        s.write('\t\t"{0}"\n\t\t{{\n\t\t\t"item_slot"\t\t"{0}"\n\t\t\t"item_type_name"\t\t"#DOTA_WearableType_{0}"\n\t\t}}\n'.format(slot))
+    s.write('\t}\n\t"items"\n\t{\n')
+    i = 0
+    while s.tell() < size:
+        hero = r.choice(heroes)
+        slot = r.choice(slots)
+        s.write('\t\t"{}"\n\t\t{{\n'.format(i))
+        s.write('\t\t\t"name"\t\t"{} \\"{}\\" {}"\n'.format(hero, slot, i))
+        s.write('\t\t\t"prefab"\t\t"{}"\n'.format(slot))
+        s.write('\t\t\t"model_player"\t\t"models/heroes/{0}/{0}_{1}_{2}.mdl"\n'.format(hero, slot, i))
+        s.write('\t\t\t"used_by_heroes"\n\t\t\t{{\n\t\t\t\t"npc_dota_hero_{}"\t\t"1"\n\t\t\t}}\n'.format(hero))
+        s.write('\t\t\t"visuals"\n\t\t\t{\n')
+        for j in range(r.randint(0, 4)):
+            s.write('\t\t\t\t"asset_modifier{}"\n\t\t\t\t{{\n'.format(j))
+            s.write('\t\t\t\t\t"type"\t\t"{}"\n'.format(r.choice(types)))
+            s.write('\t\t\t\t\t"asset"\t\t"{}_{}"\n'.format(hero, j))
+            s.write('\t\t\t\t\t"modifier"\t\t"{}_{}_{}"\n'.format(hero, i, j))
+            s.write('\t\t\t\t}\n')
+        s.write('\t\t\t}\n\t\t}\n')
+        i += 1
+    s.write('\t}\n}\n')
+    return s.getvalue()
+
+def bench(name, f, filename, size, repeat):
+    best = None
+    for i in range(repeat):
+        d = None
+        collect()
+        start = perf_counter()
+        with open(filename, "rt", encoding="utf-8") as s:
+            d = f(s)
+        t = perf_counter() - start
+        if best is None or t < best:
+            best = t
+    print("{:14} {:8.3f} s {:8.2f} MB/s".format(name, best, size / best / 2**20))
+    # don't keep the tree alive while the next parser runs
+    return dumps(d)
+
+def dumps(d):
+    s = StringIO()
+    dump(d, s)
+    return s.getvalue()
+
+def main():
+    parser = ArgumentParser(description="Compare VDF parser speed on a generated items_game.txt")
+    parser.add_argument("--size", type=float, default=8, help="Size of the generated file in MiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--file", help="Use this file instead of generating one")
+    parser.add_argument("--processes", type=int, help="Also time loading with this many processes")
+    args = parser.parse_args()
+
+    if args.file:
+        filename = args.file
+    else:
+        fd, filename = mkstemp(suffix=".txt")
+        with open(fd, "wt", encoding="utf-8") as s:
+            s.write(generate_items_game(int(args.size * 2**20)))
+    try:
+        with open(filename, "rt", encoding="utf-8") as s:
+            size = len(s.read())
+        print("Input size: {:.2f} MiB".format(size / 2**20))
+
+        d_stream = bench("load_stream", load_stream, filename, size, args.repeat)
+        d = bench("load", load, filename, size, args.repeat)
+        assert d == d_stream, "Parsers disagree"
+        d_lazy = bench("load lazy", lambda s: load(s, lazy=True), filename, size, args.repeat)
+        assert d_lazy == d, "Lazy parser disagrees"
+        if args.processes:
+            d_parallel = bench("load parallel", lambda s: load(s, processes=args.processes), filename, size, args.repeat)
+            assert d_parallel == d, "Parallel parser disagrees"
+
+        cache_dir = mkdtemp()
+        try:
+            cache = KVCache(cache_dir)
+            cache.load(filename)
+            d_cached = bench("KVCache.load", lambda s: cache.load(s.name), filename, size, args.repeat)
+            assert d_cached == d, "Cache disagrees"
+        finally:
+            rmtree(cache_dir)
+    finally:
+        if not args.file:
+            remove(filename)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from atomicfile import atomic_write, atomic_load
+from copyplan import copy_data
+from hashlib import sha256
+from marshal import dumps as marshal_dumps
+from os import link, listdir, makedirs, remove, replace, rmdir, stat, walk, getpid
+from os.path import exists, join, normpath, relpath, samestat
+from threading import Lock, get_ident
+
+def file_digest(path):
+    h = sha256()
+    with open(path, "rb") as s:
+        while True:
+            d = s.read(2**20)
+            if not d:
+                break
+            h.update(d)
+    return h.hexdigest()
+
+class DigestCache(object):
+    # file digests, which are only computed again when the size or modification time changes
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        # path -> (size, modification time, digest)
+        self.entries = atomic_load(cache_file, {})
+
+    def digest(self, path):
+        # None if path doesn't exist
+        try:
+            st = stat(path)
+        except FileNotFoundError:
+            return None
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        digest = file_digest(path)
+        self.entries[path] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def save(self):
+        atomic_write(self.cache_file, marshal_dumps(self.entries))
+
+class BlobStore(object):
+    # every distinct output is stored once under its hash, the outputs themselves are links to it
+    def __init__(self, blob_dir):
+        self.blob_dir = blob_dir
+        if not exists(blob_dir):
+            makedirs(blob_dir)
+        self.digests = set(f for f in listdir(blob_dir) if len(f) == 64)
+        self.digest_cache = DigestCache(join(blob_dir, "digests"))
+        # output path -> digest
+        self.manifest = {}
+        self.lock = Lock()
+
+    def blob_file(self, digest):
+        return join(self.blob_dir, digest)
+
+    def tmp_file(self):
+        return join(self.blob_dir, "{}.{}.tmp".format(getpid(), get_ident()))
+
+    def add_data(self, data, dest):
+        digest = sha256(data).hexdigest()
+        if digest not in self.digests:
+            tmp = self.tmp_file()
+            with open(tmp, "wb") as s:
+                s.write(data)
+            self.add_blob(tmp, digest)
+        self.link(digest, dest)
+        return digest
+
+    def add_file(self, src, dest):
+        # dest may be src, which then gets replaced by a link
+        digest = self.digest_cache.digest(src)
+        if digest not in self.digests:
+            tmp = self.tmp_file()
+            copy_data(src, tmp)
+            self.add_blob(tmp, digest)
+        self.link(digest, dest)
+        return digest
+
+    def add_blob(self, tmp, digest):
+        replace(tmp, self.blob_file(digest))
+        with self.lock:
+            self.digests.add(digest)
+
+    def link(self, digest, dest):
+        try:
+            if samestat(stat(dest), stat(self.blob_file(digest))):
+                # left from an earlier build
+                with self.lock:
+                    self.manifest[dest] = digest
+                return
+        except FileNotFoundError:
+            pass
+        # dest is replaced in one step, it never has partial contents
+        tmp = "{}.{}.{}.tmp".format(dest, getpid(), get_ident())
+        try:
+            link(self.blob_file(digest), tmp)
+        except OSError:
+            copy_data(self.blob_file(digest), tmp)
+        replace(tmp, dest)
+        with self.lock:
+            self.manifest[dest] = digest
+
+    def forget(self, dest):
+        with self.lock:
+            self.manifest.pop(dest, None)
+
+    def sync(self):
+        # make sure every output links to its blob
+        for dest, digest in list(self.manifest.items()):
+            self.link(digest, dest)
+
+    def remove_stale(self, root):
+        # remove what an earlier build left in root that isn't an output anymore
+        outputs = set(normpath(dest) for dest in self.manifest)
+        n = 0
+        for p, ds, fs in walk(root, topdown=False):
+            for f in fs:
+                if normpath(join(p, f)) not in outputs:
+                    remove(join(p, f))
+                    n += 1
+            if p != root and not listdir(p):
+                rmdir(p)
+        return n
+
+    def collect(self):
+        # remove blobs no output uses anymore
+        used = set(self.manifest.values())
+        for f in listdir(self.blob_dir):
+            if len(f) == 64 and f not in used:
+                remove(self.blob_file(f))
+                self.digests.discard(f)
+
+    def save_manifest(self, root, manifest_file):
+        # in the format of sha256sum, relative to root
+        with open(manifest_file, "wt", encoding="utf-8") as s:
+            for dest, digest in sorted(self.manifest.items()):
+                s.write("{}  {}\n".format(digest, relpath(dest, root).replace("\\", "/")))
@@ -0,0 +1,83 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from atomicfile import atomic_write, atomic_load
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from os import remove
+
+class BuildState(object):
+    # what each stage read and changed in the last build, so stages with the same inputs can be replayed
+    def __init__(self, state_file, version):
+        self.state_file = state_file
+        self.version = version
+        # kind -> function from name to fingerprint, inputs of kind "output" are outputs of earlier stages
+        self.fingerprints = {"output": lambda name: None}
+        # stage header -> (inputs, changes)
+        self.previous = {}
+        version, previous = atomic_load(state_file, (None, None), loads)
+        if version == self.version:
+            self.previous = previous
+        try:
+            # a build that doesn't finish leaves no state behind
+            remove(state_file)
+        except FileNotFoundError:
+            pass
+        self.current = {}
+        self.inputs = None
+
+    def fingerprint(self, kind, name):
+        return self.fingerprints[kind](name)
+
+    def record(self, kind, name):
+        if self.inputs is not None and (kind, name) not in self.inputs:
+            self.inputs[(kind, name)] = self.fingerprint(kind, name)
+
+    def start(self, stage):
+        self.inputs = {}
+        for kind, name in stage.inputs:
+            self.record(kind, name)
+
+    def finish(self):
+        inputs = self.inputs
+        self.inputs = None
+        return inputs
+
+    def store(self, stage, inputs, changes):
+        self.current[stage.header] = (inputs, changes)
+
+    def replays(self, stages, deps):
+        # stage index -> (inputs, changes) of the stages that don't have to run again
+        records = {}
+        for i, stage in enumerate(stages):
+            record = self.previous.get(stage.header)
+            if record is None:
+                continue
+            inputs, changes = record
+            if all(kind == "output" or self.fingerprint(kind, name) == fingerprint for (kind, name), fingerprint in inputs.items()):
+                records[i] = record
+
+        # outputs that are read or edited again are only the same if the stages that wrote them are replayed as well
+        written = {}
+        used = {}
+        for i, stage in enumerate(stages):
+            record = self.previous.get(stage.header)
+            if record is not None:
+                inputs, changes = record
+                written[i] = set(k for changed, removed in changes for k, v in changed)
+                used[i] = set(name for kind, name in inputs if kind == "output")
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(stages)):
+                for j in deps[i]:
+                    if (i in records) == (j in records):
+                        continue
+                    if i in used and j in written and not used[i] & written[j]:
+                        continue
+                    records.pop(i, None)
+                    records.pop(j, None)
+                    changed = True
+        return records
+
+    def save(self):
+        atomic_write(self.state_file, dumps((self.version, self.current), HIGHEST_PROTOCOL))
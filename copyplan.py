@@ -0,0 +1,107 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from os import replace, stat, getpid
+from shutil import copyfile
+from sys import stderr
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+
+def copy_data(src, dest):
+    # copy_file_range lets the filesystem clone or share the data where it can
+    if copy_file_range is not None:
+        try:
+            with open(src, "rb") as s, open(dest, "wb") as d:
+                size = stat(s.fileno()).st_size
+                while size > 0:
+                    n = copy_file_range(s.fileno(), d.fileno(), size)
+                    if n == 0:
+                        break
+                    size -= n
+                if size == 0:
+                    return
+        except OSError:
+            pass
+    copyfile(src, dest)
+
+def write_data(store, src, dest):
+    # src is a file name or the contents themselves
+    if isinstance(src, bytes):
+        return store.add_data(src, dest)
+    return store.add_file(src, dest)
+
+class CopyPlan(object):
+    # copies are recorded first and written at the end, so each source is only read once
+    def __init__(self, store, threads=8):
+        self.store = store
+        self.threads = threads
+        # destination -> source file or contents, None if the destination was written some other way
+        self.sources = {}
+        # destinations that still have to be written, in order
+        self.pending = {}
+        # destinations edited in place since the last run, which are stored again then
+        self.edited = set()
+
+    def source(self, path):
+        # a planned destination has the same contents as its source
+        while self.sources.get(path) is not None:
+            path = self.sources[path]
+        return path
+
+    def add(self, src, dest):
+        src = self.source(src)
+        if src == dest:
+            return
+        if dest in self.sources:
+            first_src = self.sources[dest]
+            if first_src is None:
+                print("Warning: not copying '{}' to '{}' because it was already written".format(src, dest), file=stderr)
+            elif first_src != src:
+                print("Warning: not copying '{}' to '{}' because it was already written from '{}'".format(src, dest, first_src), file=stderr)
+            return
+        self.sources[dest] = src
+        self.pending[dest] = None
+
+    def write(self, data, dest):
+        # writing directly overrides any copy to dest
+        self.pending.pop(dest, None)
+        self.edited.discard(dest)
+        self.sources[dest] = None
+        self.store.add_data(data, dest)
+
+    def prepare_edit(self, dest):
+        # dest is about to be edited in place, so it needs its own copy of the data now
+        if dest in self.pending:
+            del self.pending[dest]
+            write_data(self.store, self.sources[dest], dest)
+        # don't edit the stored blob or other outputs linked to it
+        if stat(dest).st_nlink > 1:
+            tmp = "{}.{}.tmp".format(dest, getpid())
+            copy_data(dest, tmp)
+            replace(tmp, dest)
+        self.store.forget(dest)
+        self.edited.add(dest)
+        self.sources[dest] = None
+
+    def run(self):
+        groups = {}
+        for dest in self.pending:
+            groups.setdefault(self.sources[dest], []).append(dest)
+        self.pending = {}
+        edited = self.edited
+        self.edited = set()
+        with ThreadPoolExecutor(self.threads) as executor:
+            fs = [executor.submit(run_group, self.store, src, dests) for src, dests in groups.items()]
+            fs += [executor.submit(self.store.add_file, dest, dest) for dest in edited]
+            for f in fs:
+                f.result()
+        return len(groups)
+
+def run_group(store, src, dests):
+    # the source is only read once, all copies link to its blob
+    digest = write_data(store, src, dests[0])
+    for dest in dests[1:]:
+        store.link(digest, dest)
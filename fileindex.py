@@ -0,0 +1,45 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from os import walk
+from os.path import relpath
+from posixpath import dirname, join
+
+def canonical_file(p):
+    return p.lower().replace("\\", "/")
+
+class FileIndex(object):
+    # the canonical paths of the files below a directory, so existence checks don't need a stat
+    def __init__(self, root=None):
+        # path -> None, in the order of os.walk
+        self.files = {}
+        self.dirs = set()
+        if root is not None:
+            for p, ds, fs in walk(root):
+                rel_p = canonical_file(relpath(p, root))
+                if rel_p == ".":
+                    rel_p = ""
+                self.dirs.add(rel_p)
+                for f in fs:
+                    self.files[join(rel_p, canonical_file(f))] = None
+
+    def __contains__(self, p):
+        return canonical_file(p) in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def has_dir(self, p):
+        return canonical_file(p).rstrip("/") in self.dirs
+
+    def add(self, p):
+        p = canonical_file(p)
+        self.files[p] = None
+        d = dirname(p)
+        while d not in self.dirs:
+            self.dirs.add(d)
+            d = dirname(d)
+
+    def files_in(self, d):
+        prefix = canonical_file(d).rstrip("/") + "/"
+        return [p for p in self.files if p.startswith(prefix)]
@@ -1,13 +1,11 @@
-from vdf import load
+from kvcache import load_file, from_environment
 from collections import OrderedDict
 from sys import argv
 import csv
 
-with open(argv[1] + "/scripts/npc/npc_heroes.txt", "rt", encoding="utf-8") as input:
-    d = load(input)
-
-with open(argv[2] + "dota/resource/dota_english.txt", "rt", encoding="utf-16") as input:
-    l = load(input)
+cache = from_environment()
+d = load_file(argv[1] + "/scripts/npc/npc_heroes.txt", cache=cache)
+l = load_file(argv[2] + "dota/resource/dota_english.txt", encoding="utf-16", cache=cache)
 
 fields = OrderedDict([
     ("id", "HeroID"),
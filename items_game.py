@@ -0,0 +1,81 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from kvlist import KVList
+from sys import stderr
+
+class ItemsGame(object):
+    # indexes over scripts/items/items_game.txt, built once
+    def __init__(self, d):
+        items_game = d["items_game"]
+        self.items = list(items_game["items"])
+        self.prefabs = items_game["prefabs"]
+        self.asset_modifiers = items_game["asset_modifiers"]
+        self.attached_particles = items_game["attribute_controlled_attached_particles"]
+
+        self.by_id = {}
+        self.by_name = {}
+        self.slots = {}
+        self.heroes = {}
+        self.defaults = {}
+        self.visuals_by_type = {}
+        for id, item in self.items:
+            self.by_id[id] = item
+            name = item.get("name")
+            if name is not None:
+                self.by_name.setdefault(name, (id, item))
+            slot = self.attrib(item, "item_slot")
+            hero = get_hero(item)
+            self.slots[id] = slot
+            self.heroes[id] = hero
+
+            if self.attrib(item, "baseitem") == "1":
+                assert slot is not None, id
+                assert hero is not None, id
+                if (hero, slot) in self.defaults:
+                    print("Warning: id '{}' is a duplicate default for '{}'".format(id, (hero, slot)), file=stderr)
+                else:
+                    self.defaults[(hero, slot)] = id
+
+            for k, v in item.get("visuals", []):
+                if k.startswith("asset_modifier") and isinstance(v, KVList):
+                    self.visuals_by_type.setdefault(v.get("type"), []).append((id, k, v))
+
+        self.default_ids = set(self.defaults.values())
+
+    def attrib(self, item, key):
+        v = item.get(key)
+        if v is None and "prefab" in item:
+            v = self.prefabs[item["prefab"]].get(key)
+        return v
+
+    def item(self, id):
+        return self.by_id[id]
+
+    def find_by_name(self, name):
+        return self.by_name.get(name)
+
+    def default_id(self, id):
+        return self.defaults.get((self.heroes[id], self.slots[id]))
+
+    def default_item(self, id):
+        default_id = self.default_id(id)
+        if default_id is None:
+            return None
+        return self.by_id[default_id]
+
+    def visuals_of_type(self, type, ids=None):
+        visuals = self.visuals_by_type.get(type, [])
+        if ids is not None:
+            visuals = [(id, k, v) for (id, k, v) in visuals if id in ids]
+        return visuals
+
+def get_hero(item):
+    if "used_by_heroes" not in item or item["used_by_heroes"] in ["0", "1"]:
+        return None
+    heroes = list(item["used_by_heroes"].keys())
+    if len(heroes) != 1:
+        return None
+    hero = heroes[0]
+    assert item["used_by_heroes"][hero] == "1"
+    return hero
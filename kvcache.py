@@ -0,0 +1,83 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from vdf import loads, gc_paused
+from kvlist import to_plain, from_plain
+from atomicfile import atomic_write, atomic_load
+from marshal import dumps as marshal_dumps
+from hashlib import sha1
+from os import environ, listdir, makedirs, remove, stat, utime
+from os.path import abspath, exists, join
+
+cache_version = 1
+
+class KVCache(object):
+    def __init__(self, cache_dir, max_size=2**28):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not exists(cache_dir):
+            makedirs(cache_dir)
+
+    def cache_file(self, path, encoding, parse):
+        key = "\0".join([abspath(path), encoding, parse.__module__, parse.__name__])
+        return join(self.cache_dir, sha1(key.encode()).hexdigest() + ".kv")
+
+    def load(self, path, encoding="utf-8", parse=loads):
+        st = stat(path)
+        source = (cache_version, abspath(path), st.st_size, st.st_mtime_ns)
+        cache_file = self.cache_file(path, encoding, parse)
+        cached_source, tree = atomic_load(cache_file, (None, None))
+        if cached_source == source:
+            with gc_paused():
+                d = from_plain(tree)
+            try:
+                # the modification time of a cache file is its last use
+                utime(cache_file)
+            except FileNotFoundError:
+                # evicted by another process
+                pass
+            return d
+
+        with open(path, "rt", encoding=encoding) as s:
+            d = parse(s.read())
+        self.store(cache_file, source, d)
+        return d
+
+    def store(self, cache_file, source, d):
+        atomic_write(cache_file, marshal_dumps((source, to_plain(d))))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for f in listdir(self.cache_dir):
+            if f.endswith(".kv"):
+                try:
+                    st = stat(join(self.cache_dir, f))
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, f))
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        # keep at least the newest entry
+        for _, size, f in entries[:-1]:
+            if total_size <= self.max_size:
+                break
+            try:
+                remove(join(self.cache_dir, f))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+def from_environment():
+    cache_dir = environ.get("NOHATS_CACHE_DIR")
+    if cache_dir is None:
+        return None
+    max_size = int(environ.get("NOHATS_CACHE_SIZE", 256)) * 2**20
+    return KVCache(cache_dir, max_size)
+
+def load_file(path, encoding="utf-8", parse=loads, cache=None):
+    if cache is None:
+        with open(path, "rt", encoding=encoding) as s:
+            return parse(s.read())
+    return cache.load(path, encoding, parse)
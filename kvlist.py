@@ -1,54 +1,102 @@
 # Copyright (c) Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from collections import MutableMapping
+from collections.abc import MutableMapping
+
+# lists with more items than this get a key index
+index_threshold = 8
 
 class KVList(MutableMapping):
+    # there are hundreds of thousands of these in items_game.txt, so keep them small
+    __slots__ = ("key_list", "value_list", "index")
+
     def __init__(self, *args, **kwargs):
-        self.list = []
-        self.update(*args, **kwargs)
+        self.key_list = []
+        self.value_list = []
+        # key -> position of its last value, in order of first occurrence
+        self.index = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def build_index(self):
+        self.index = {k: i for i, k in enumerate(self.key_list)}
 
     def last_index(self, key):
-        l = len(self.list)
-        for i in range(l):
-            if self.list[l-i-1][0] == key:
-                return l-i-1
-        return None
+        if self.index is not None:
+            return self.index.get(key)
+        keys = self.key_list
+        try:
+            i = keys.index(key)
+        except ValueError:
+            return None
+        while True:
+            try:
+                i = keys.index(key, i+1)
+            except ValueError:
+                return i
 
     def __getitem__(self, key):
         idx = self.last_index(key)
         if idx is None:
             raise KeyError(key)
-        return self.list[idx][1]
+        return self.value_list[idx]
 
     def __setitem__(self, key, value):
-        self.list.append((key, value))
+        self.key_list.append(key)
+        self.value_list.append(value)
+        if self.index is not None:
+            self.index[key] = len(self.key_list) - 1
+        elif len(self.key_list) > index_threshold:
+            self.build_index()
 
     def __delitem__(self, key):
         idx = self.last_index(key)
         if idx is None:
             raise KeyError(key)
-        del self.list[idx]
+        del self.key_list[idx]
+        del self.value_list[idx]
+        if self.index is not None:
+            self.build_index()
+
+    def __contains__(self, key):
+        if self.index is not None:
+            return key in self.index
+        return key in self.key_list
+
+    def get(self, key, default=None):
+        idx = self.last_index(key)
+        if idx is None:
+            return default
+        return self.value_list[idx]
 
     def __iter__(self):
-        for e in self.list:
-            yield e
+        return zip(self.key_list, self.value_list)
 
     def __len__(self):
-        return len(self.list)
+        return len(self.key_list)
 
     def items(self):
         return list(self)
 
     def keys(self):
-        keys = []
-        for k, v in self:
-            if k not in keys:
-                keys.append(k)
-        return keys
+        if self.index is not None:
+            return list(self.index)
+        return list(dict.fromkeys(self.key_list))
 
     def values(self):
-        return [v for k, v in self]
+        return list(self.value_list)
 
     def __repr__(self):
-        return "KVList({})".format(repr(self.list))
+        return "KVList({})".format(repr(list(self)))
+
+def to_plain(d):
+    # nested lists of (key, value) tuples, for marshal and pickle
+    return [(k, to_plain(v) if isinstance(v, KVList) else v) for k, v in d]
+
+def from_plain(l):
+    d = KVList()
+    d.key_list = [k for k, v in l]
+    d.value_list = [from_plain(v) if isinstance(v, list) else v for k, v in l]
+    if len(l) > index_threshold:
+        d.build_index()
+    return d
@@ -2,6 +2,8 @@
 # Released under the Expat license, see LICENSE file for details
 
 from binary import Struct, Magic, Format, Offset, Seek, Array, FixedString, String, Pointer
+from collections import OrderedDict
+from os import stat
 
 class MDL(Struct):
     def fields(self):
@@ -220,3 +222,36 @@ class Event(Struct):
         self.F("type", Format("I"))
         self.F("options", FixedString(64))
         self.F("szeventindex", RelativeString(base, "i"))
+
+class MDLCache(object):
+    # the most recently parsed models, for models that are read more than once
+    def __init__(self, max_models=32):
+        self.max_models = max_models
+        # path -> ((size, modification time), MDL)
+        self.models = OrderedDict()
+
+    def load(self, path):
+        # shared with other users, so don't change it
+        st = stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        entry = self.models.get(path)
+        if entry is not None and entry[0] == key:
+            self.models.move_to_end(path)
+            return entry[1]
+        m = MDL()
+        with open(path, "rb") as s:
+            m.unpack(s)
+        self.models[path] = (key, m)
+        self.models.move_to_end(path)
+        while len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return m
+
+    def take(self, path):
+        # for changing it, so it leaves the cache
+        m = self.load(path)
+        del self.models[path]
+        return m
+
+    def invalidate(self, path):
+        self.models.pop(path, None)
@@ -1,175 +1,218 @@
 # Copyright (c) Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from vdf import load, dump
-from os.path import abspath, exists, dirname, join
+from vdf import loads, loads_parallel, dump
+from kvcache import KVCache, load_file
+from fileindex import FileIndex, canonical_file
+from copyplan import CopyPlan
+from blobstore import BlobStore, file_digest
+from buildstate import BuildState
+from stageprof import StageProfiler
+from scheduler import Stage, run_stages
+from vpklib import VPKReader
+from os.path import abspath, exists, dirname, basename, join
 from os import SEEK_END
-from sys import argv, stdout, stderr, version
-from shutil import copyfile
-from os import makedirs, listdir, walk, name as os_name
-from kvlist import KVList
-from mdl import MDL, LocalSequence
-from pcf import PCF
+from sys import stdout, stderr, version
+from os import makedirs, listdir, environ, name as os_name
+from kvlist import KVList, to_plain
+from hashlib import sha256
+from marshal import dumps as marshal_dumps
+from items_game import ItemsGame
+from mdl import MDLCache, LocalSequence
+from pcf import PCF, RawPCF, PCFCache, SystemIndex
 from swf import ScaleFormSWF, Matrix
 from wave import open as wave_open
+from io import BytesIO
 from collections import OrderedDict
-from io import StringIO
 from itertools import chain
+from multiprocessing import get_context
 from binary import FakeWriteStream
-from random import randint, seed
+from random import Random, randint, seed
 from re import subn
+from argparse import ArgumentParser
 
 def header(s):
+    if profiler is not None:
+        profiler.start(s)
     print("== {} ==".format(s))
 
-def canonical_file(p):
-    return p.lower().replace("\\", "/")
-
 def dota_file(p):
-    return join(dota_dir, canonical_file(p))
+    path = join(dota_dir, canonical_file(p))
+    if vpk_reader is not None and path not in vpk_extracted and p in vpk_reader:
+        # unpacked when it's first used
+        vpk_reader.extract(p, path)
+        vpk_extracted.add(path)
+    record_input("file", path)
+    return path
 
 def nohats_file(p):
     return join(nohats_dir, canonical_file(p))
 
+def load_kv(path, parse=loads):
+    return load_file(path, parse=parse, cache=kv_cache)
+
 def source_file(src):
-    if nohats_dir and exists(nohats_file(src)):
-        src = nohats_file(src)
+    if nohats_dir and src in nohats_files:
+        src = copy_plan.source(nohats_file(src))
+        if src in copy_plan.sources:
+            # written or edited by an earlier stage
+            record_input("output", src)
+        elif isinstance(src, str):
+            # a planned copy of a game file
+            record_input("file", src)
     else:
         src = dota_file(src)
     return src
 
+def source_exists(src):
+    if nohats_dir and src in nohats_files:
+        source_file(src)
+        return True
+    dota_file(src)
+    return src in dota_files
+
+def record_input(kind, name):
+    if build_state is not None:
+        build_state.record(kind, name)
+
+def add_output(p):
+    # the path of p in nohats_dir, with its directory created
+    dest = nohats_file(p)
+    if not nohats_files.has_dir(dirname(canonical_file(p))):
+        makedirs(dirname(dest), exist_ok=True)
+    nohats_files.add(p)
+    return dest
+
+def write_output(p, data):
+    dest = add_output(p)
+    mdl_cache.invalidate(dest)
+    pcf_cache.invalidate(dest)
+    copy_plan.write(data, dest)
+
+def edit_file(p):
+    # the path to edit p in place
+    dest = add_output(p)
+    record_input("output", dest)
+    mdl_cache.invalidate(dest)
+    pcf_cache.invalidate(dest)
+    copy_plan.prepare_edit(dest)
+    return dest
+
+def build_version():
+    # a build state is only valid for the same code and directories
+    h = sha256()
+    code_dir = dirname(abspath(__file__))
+    for f in sorted(listdir(code_dir)):
+        if f.endswith(".py"):
+            with open(join(code_dir, f), "rb") as s:
+                h.update(s.read())
+    h.update("\0".join([dota_dir, nohats_dir]).encode())
+    return h.hexdigest()
+
+def parse_items_game(text):
+    # every item is used, so parsing lazily would only add overhead
+    if jobs > 1:
+        return loads_parallel(text, jobs)
+    return loads(text)
+
 def nohats():
     header("Loading items_game.txt")
-    with open(dota_file("scripts/items/items_game.txt"), "rt", encoding="utf-8") as input:
-        d = load(input)
+    d = load_kv(dota_file("scripts/items/items_game.txt"), parse_items_game)
 
     header("Getting defaults")
-    defaults = get_defaults(d)
-    default_ids = set(defaults.values())
+    items_game = ItemsGame(d)
     header("Getting visuals")
-    visuals = get_visuals(d, default_ids)
+    visuals = get_visuals(items_game)
     visuals = filter_visuals(visuals)
     header("Loading npc_units.txt")
     units = get_units()
     header("Loading npc_heroes.txt")
     npc_heroes = get_npc_heroes()
 
-    header("Fixing scaleform files")
-    fix_scaleform()
-
-    header("Fixing simple model files")
-    fix_models(d, defaults, default_ids)
-    header("Fixing alternate style models")
-    visuals = fix_style_models(d, visuals, defaults)
-    header("Fixing additional wearables")
-    visuals = fix_additional_wearables(d, visuals, defaults)
-    header("Fixing hex models")
-    visuals = fix_hex_models(d, visuals)
-    header("Fixing pet models")
-    visuals = fix_pet_models(visuals)
-    header("Fixing portrait models")
-    visuals = fix_portrait_models(visuals)
-    header("Fixing sounds")
-    visuals = fix_sounds(visuals)
-    header("Fixing icons")
-    visuals = fix_hero_icons(visuals)
-    visuals = fix_ability_icons(visuals)
-    header("Fixing summons")
-    visuals = fix_summons(visuals, units, d, default_ids)
-    header("Fixing alternate hero models")
-    visuals = fix_hero_forms(visuals)
-    header("Fixing particle snapshots")
-    visuals = fix_particle_snapshots(visuals)
-    header("Fixing animations")
-    visuals = fix_animations(d, visuals, npc_heroes)
-    header("Fixing alternate base models")
-    visuals = fix_base_models(visuals, npc_heroes)
-    header("Fixing skins")
     courier_model = units["DOTAUnits"]["npc_dota_courier"]["Model"]
     flying_courier_model = units["DOTAUnits"]["npc_dota_flying_courier"]["Model"]
-    fix_skins(courier_model, flying_courier_model)
-    header("Fixing couriers")
-    visuals = fix_couriers(visuals, units, courier_model)
-    visuals = fix_flying_couriers(visuals, units, flying_courier_model)
-    header("Fixing particle color")
-    fix_particle_color(npc_heroes)
-    header("Fixing effigies")
-    fix_effigies()
-    header("Fixing particles")
-    visuals = fix_particles(d, defaults, default_ids, visuals, units, npc_heroes)
 
-    assert not visuals, visuals
-
-def get_attrib(d, item, key):
-    v = item.get(key)
-    if v is None and "prefab" in item:
-        v = d["items_game"]["prefabs"][item["prefab"]].get(key)
-    return v
-
-def get_hero(d, item):
-    if "used_by_heroes" not in item or item["used_by_heroes"] in ["0", "1"]:
-        return None
-    heroes = list(item["used_by_heroes"].keys())
-    if len(heroes) != 1:
-        return None
-    hero = heroes[0]
-    assert item["used_by_heroes"][hero] == "1"
-    return hero
-
-def get_slot(d, item):
-    return get_attrib(d, item, "item_slot")
-
-def get_item(d, id):
-    return d["items_game"]["items"][id]
-
-def find_item_by_name(d, name):
-    for id, item in d["items_game"]["items"]:
-        if item.get("name") == name:
-            return (id, item)
-    return None
+    def fix_icons():
+        fix_hero_icons(visuals)
+        fix_ability_icons(visuals)
+
+    def fix_all_couriers():
+        fix_couriers(visuals, units, courier_model)
+        fix_flying_couriers(visuals, units, flying_courier_model)
+
+    items_game_input = ("file", dota_file("scripts/items/items_game.txt"))
+    units_input = ("file", dota_file("scripts/npc/npc_units.txt"))
+    heroes_input = ("file", dota_file("scripts/npc/npc_heroes.txt"))
+
+    # stages that write the same kind of files run in this order, the others can run at the same time
+    stages = [
+        Stage("Fixing scaleform files", fix_scaleform, writes=["scaleform"]),
+        Stage("Fixing simple model files", lambda: fix_models(items_game), writes=["models"], inputs=[items_game_input]),
+        Stage("Fixing alternate style models", lambda: fix_style_models(items_game, visuals), writes=["models"], inputs=[items_game_input]),
+        Stage("Fixing additional wearables", lambda: fix_additional_wearables(items_game, visuals), writes=["models"], inputs=[items_game_input]),
+        Stage("Fixing hex models", lambda: fix_hex_models(items_game, visuals), writes=["models"], inputs=[items_game_input]),
+        Stage("Fixing pet models", lambda: fix_pet_models(visuals), writes=["models"]),
+        Stage("Fixing portrait models", lambda: fix_portrait_models(visuals), writes=["models"]),
+        Stage("Fixing sounds", lambda: fix_sounds(visuals), writes=["sounds"]),
+        Stage("Fixing icons", fix_icons, writes=["icons"]),
+        Stage("Fixing summons", lambda: fix_summons(visuals, units, items_game), writes=["models"], inputs=[items_game_input, units_input]),
+        Stage("Fixing alternate hero models", lambda: fix_hero_forms(visuals), writes=["models"]),
+        Stage("Fixing particle snapshots", lambda: fix_particle_snapshots(visuals), writes=["particle_snapshots"]),
+        Stage("Fixing animations", lambda: fix_animations(visuals, npc_heroes), writes=["models"], inputs=[heroes_input]),
+        Stage("Fixing alternate base models", lambda: fix_base_models(visuals, npc_heroes), writes=["models"], inputs=[heroes_input]),
+        Stage("Fixing skins", lambda: fix_skins(courier_model, flying_courier_model), writes=["models"], inputs=[units_input]),
+        Stage("Fixing couriers", fix_all_couriers, writes=["models"], inputs=[units_input]),
+        Stage("Fixing particle color", lambda: fix_particle_color(npc_heroes), writes=["particles"], inputs=[heroes_input]),
+        Stage("Fixing effigies", fix_effigies, writes=["models"]),
+        Stage("Fixing particles", lambda: fix_particles(items_game, visuals, units, npc_heroes), writes=["particles"], inputs=[items_game_input, units_input, heroes_input]),
+        ]
+    state = [copy_plan.sources, copy_plan.pending, copy_plan.edited, nohats_files.files, nohats_files.dirs, visuals.types, visuals.keys]
+    if blob_store is not None:
+        # blobs written by workers are found again on disk when needed
+        state += [blob_store.manifest, blob_store.digest_cache.entries]
+    if build_state is not None:
+        build_state.fingerprints["visuals"] = visuals.fingerprint
+    untracked = []
+    if profiler is not None:
+        profiler.finish()
+        for stage in stages:
+            stage.f = profiler.wrap(stage.header, stage.f)
+        # measurements of replayed stages aren't replayed
+        untracked.append(profiler.stages)
+    run_stages(stages, jobs, state, build_state, untracked, seed_num)
+
+    header("Writing copies")
+    ncopies = len(copy_plan.pending)
+    print("{} copies of {} files".format(ncopies, copy_plan.run()))
+    if nohats_dir:
+        blob_store.sync()
+        print("Removed {} stale files".format(blob_store.remove_stale(nohats_dir)))
+        blob_store.collect()
+        blob_store.digest_cache.save()
+        blob_store.save_manifest(nohats_dir, join(blob_store.blob_dir, "manifest.txt"))
+        print("{} files stored as {} blobs".format(len(blob_store.manifest), len(set(blob_store.manifest.values()))))
+    if build_state is not None:
+        build_state.save()
+    if profiler is not None:
+        profiler.finish()
 
-def get_defaults(d):
-    defaults = {}
-    for id, item in d["items_game"]["items"]:
-        if get_attrib(d, item, "baseitem") == "1":
-            slot = get_slot(d, item)
-            assert slot is not None, id
-            hero = get_hero(d, item)
-            assert hero is not None, id
-            if (hero, slot) in defaults:
-                print("Warning: id '{}' is a duplicate default for '{}'".format(id, (hero, slot)), file=stderr)
-            else:
-                defaults[(hero, slot)] = id
-    return defaults
-
-def get_default_item(d, defaults, item):
-    hero = get_hero(d, item)
-    slot = get_slot(d, item)
-    default_id = defaults.get((hero, slot))
-    if default_id is None:
-        return None
-    default_item = get_item(d, default_id)
-    return default_item
+    assert not visuals, visuals
 
 def copy(src, dest, dota=True):
     print("copy '{}' to '{}'".format(src, dest))
-    if not exists(dota_file(dest)) and not dest.endswith(".cloth"):
+    if dest not in dota_files and not dest.endswith(".cloth"):
         print("Warning: trying to override '{}' which does not exist".format(dest), file=stderr)
     if dota:
+        src_exists = source_exists(src)
         src = source_file(src)
-    if not exists(src):
+    else:
+        src_exists = exists(src)
+    if not src_exists:
         print("Warning: source file {} does not exist".format(src), file=stderr)
         return
-    dest = nohats_file(dest)
-    if src == dest:
-        return
-    dest_dir = dirname(dest)
     if nohats_dir is None:
         return
-    if not exists(dest_dir):
-        makedirs(dest_dir)
-    if not exists(dest):
-        copyfile(src, dest)
+    copy_plan.add(src, add_output(dest))
 
 def copy_model(src, dest):
     if src != dest:
@@ -183,13 +226,12 @@ def copy_model_always(src, dest):
     copy(src + ".mdl", dest + ".mdl")
     copy(src + ".vvd", dest + ".vvd")
     copy(src + ".dx90.vtx", dest + ".dx90.vtx")
-    if exists(source_file(src + ".cloth")):
+    if source_exists(src + ".cloth"):
         copy(src + ".cloth", dest + ".cloth")
     else:
         print("Create empty cloth file '{}'".format(dest + ".cloth"))
         if nohats_dir:
-            with open(nohats_file(dest + ".cloth"), "wb") as s:
-                s.write(b"ClothSystem\r\n{\r\n}\r\n")
+            copy_plan.add(b"ClothSystem\r\n{\r\n}\r\n", add_output(dest + ".cloth"))
 
 def has_alternate_skins(item):
     if item.get("skin", "0") != "0":
@@ -210,37 +252,35 @@ def fix_item_model(item, default_item, model_player):
             return
         copy_model(default_item[model_player], item[model_player])
         if has_alternate_skins(item):
-            m = MDL()
-            with open(source_file(default_item[model_player]), "rb") as s:
-                m.unpack(s)
+            m = mdl_cache.load(source_file(default_item[model_player]))
             if m["numskinfamilies"].data != 1:
                 print("Warning: model '{}' has '{}' skin families, need to fix '{}'".format(default_item[model_player], m["numskinfamilies"].data, item[model_player]), file=stderr)
     else:
         copy_model("models/development/invisiblebox.mdl", item[model_player])
 
-def fix_models(d, defaults, default_ids):
-    for id, item in d["items_game"]["items"]:
-        if id == "default" or id in default_ids:
+def fix_models(items_game):
+    for id, item in items_game.items:
+        if id == "default" or id in items_game.default_ids:
             continue
         for model_player in ["model_player", "model_player1", "model_player2", "model_player3", "model_player4"]:
             if model_player in item:
-                default_item = get_default_item(d, defaults, item)
+                default_item = items_game.default_item(id)
                 fix_item_model(item, default_item, model_player)
 
-def get_visuals(d, default_ids):
+def get_visuals(items_game):
     # get visual modifiers
     visuals = []
-    for id, item in d["items_game"]["items"]:
-        # if id == "default" or id in default_ids:
+    for id, item in items_game.items:
+        # if id == "default" or id in items_game.default_ids:
         #     continue
-        slot = get_slot(d, item)
+        slot = items_game.slots[id]
         if slot in ["weather", "music"]:
             continue
         if "visuals" in item:
             for k, v in item["visuals"]:
                 visuals.append((id, k, v))
 
-    for k, v in d["items_game"]["asset_modifiers"]:
+    for k, v in items_game.asset_modifiers:
         for k_, v_ in v:
             if k_.startswith("asset_modifier"):
                 k_ = k_[len("asset_modifier"):]
@@ -252,8 +292,10 @@ def get_visuals(d, default_ids):
     return visuals
 
 def filter_visuals(visuals):
+    visuals = Visuals(visuals)
+
     # particle systems are handled seperately as a group per item
-    visuals = [(id, k, v) for (id, k, v) in visuals if not k.startswith("attached_particlesystem")]
+    visuals.pop_key_prefix("attached_particlesystem")
 
     # random stuff
     ignore_keys = [
@@ -264,7 +306,8 @@ def filter_visuals(visuals):
         "player_card",
         "hide_on_portrait",
     ]
-    visuals = [(id, k, v) for (id, k, v) in visuals if k not in ignore_keys]
+    for key in ignore_keys:
+        visuals.pop_key(key)
 
     ignore_types = [
         "announcer",
@@ -284,26 +327,61 @@ def filter_visuals(visuals):
         "entity_healthbar_offset",
         "portrait_game",
         ]
-    to_ignore = invisualtypes(ignore_types)
-    visuals = [x for x in visuals if not to_ignore(x)]
+    for type in ignore_types:
+        visuals.pop_type(type)
 
     return visuals
 
-def filtersplit(l, f):
-    a = []
-    b = []
-    for e in l:
-        if f(e):
-            a.append(e)
+class Visuals(object):
+    # visuals bucketed by asset modifier type, or by key for other visuals, so stages can take theirs
+    def __init__(self, visuals):
+        self.types = OrderedDict()
+        self.keys = OrderedDict()
+        for id, k, v in visuals:
+            if k.startswith("asset_modifier"):
+                self.types.setdefault(v.get("type"), []).append((id, k, v))
+            else:
+                self.keys.setdefault(k, []).append((id, k, v))
+
+    def pop_type(self, type):
+        record_input("visuals", ("type", type))
+        return self.types.pop(type, [])
+
+    def pop_key(self, key):
+        record_input("visuals", ("key", key))
+        return self.keys.pop(key, [])
+
+    def pop_key_prefix(self, prefix):
+        record_input("visuals", ("key_prefix", prefix))
+        l = []
+        for key in [k for k in self.keys if k.startswith(prefix)]:
+            l += self.keys.pop(key)
+        return l
+
+    def fingerprint(self, name):
+        kind, value = name
+        if kind == "type":
+            l = self.types.get(value, [])
+        elif kind == "key":
+            l = self.keys.get(value, [])
         else:
-            b.append(e)
-    return (a, b)
+            l = [x for k, v in self.keys.items() if k.startswith(value) for x in v]
+        plain = [(id, k, to_plain(v) if isinstance(v, KVList) else v) for id, k, v in l]
+        return sha256(marshal_dumps(plain)).hexdigest()
+
+    def __iter__(self):
+        return chain(chain.from_iterable(self.types.values()), chain.from_iterable(self.keys.values()))
+
+    def __len__(self):
+        return sum(len(l) for l in chain(self.types.values(), self.keys.values()))
 
-def fix_style_models(d, visuals, defaults):
-    styles_visuals, visuals = filtersplit(visuals, lambda id_k_v: id_k_v[1] == "styles")
+    def __repr__(self):
+        return repr(list(self))
+
+def fix_style_models(items_game, visuals):
+    styles_visuals = visuals.pop_key("styles")
     for id, _, visual in styles_visuals:
-        item = get_item(d, id)
-        default_item = get_default_item(d, defaults, item)
+        default_item = items_game.default_item(id)
         for styleid, v in visual:
             if not "model_player" in v:
                 continue
@@ -311,15 +389,6 @@ def fix_style_models(d, visuals, defaults):
 
     return visuals
 
-def invisualtypes(types):
-    def filter(e):
-        id, k, v = e
-        return k.startswith("asset_modifier") and v.get("type") in types
-    return filter
-
-def isvisualtype(type):
-    return invisualtypes([type])
-
 def assetmodifier1(visual):
     type = visual.pop("type")
     asset = visual.pop("asset", None)
@@ -346,8 +415,8 @@ def assetmodifier(iterable):
     for id, key, visual in iterable:
         yield assetmodifier1(visual)
 
-def fix_additional_wearables(d, visuals, defaults):
-    additional_wearable_visuals, visuals = filtersplit(visuals, isvisualtype("additional_wearable"))
+def fix_additional_wearables(items_game, visuals):
+    additional_wearable_visuals = visuals.pop_type("additional_wearable")
     additional_wearables = OrderedDict()
     for id, k, v in additional_wearable_visuals:
         asset, modifier = assetmodifier1(v)
@@ -355,22 +424,18 @@ def fix_additional_wearables(d, visuals, defaults):
         assert id not in additional_wearables, id
         additional_wearables[id] = asset
     for id, asset in additional_wearables.items():
-        item = get_item(d, id)
-        hero = get_hero(d, item)
-        slot = get_slot(d, item)
-        default_id = defaults[(hero, slot)]
+        default_id = items_game.defaults[(items_game.heroes[id], items_game.slots[id])]
         if id == default_id:
             continue
         copy_model(additional_wearables[default_id], asset)
     return visuals
 
-def fix_hex_models(d, visuals):
-    hex_visuals, visuals = filtersplit(visuals, isvisualtype("hex_model"))
+def fix_hex_models(items_game, visuals):
+    hex_visuals = visuals.pop_type("hex_model")
     for id, k, v in hex_visuals:
         asset, modifier = assetmodifier1(v)
         assert asset == "hex"
-        item = get_item(d, id)
-        hero = get_hero(d, item)
+        hero = items_game.heroes[id]
         if hero == "npc_dota_hero_lion":
             hex_model = "models/props_gameplay/frog.mdl"
         elif hero == "npc_dota_hero_shadow_shaman":
@@ -381,7 +446,7 @@ def fix_hex_models(d, visuals):
     return visuals
 
 def fix_pet_models(visuals):
-    pet_visuals, visuals = filtersplit(visuals, isvisualtype("pet"))
+    pet_visuals = visuals.pop_type("pet")
     for id, key, visual in pet_visuals:
         pickup_model = visual.pop("pickup_item", None)
         strange_type = visual.pop("strange_type", None)
@@ -393,7 +458,7 @@ def fix_pet_models(visuals):
     return visuals
 
 def fix_portrait_models(visuals):
-    portrait_visuals, visuals = filtersplit(visuals, isvisualtype("portrait_background_model"))
+    portrait_visuals = visuals.pop_type("portrait_background_model")
     for asset, modifier in assetmodifier(portrait_visuals):
         copy_model("models/heroes/pedestal/pedestal_1_small.mdl", asset)
     return visuals
@@ -508,12 +573,8 @@ def copy_wave(src, dest):
 
         if nohats_dir is None:
             return
-        dest_file = nohats_file(dest)
-        dest_dir = dirname(dest_file)
-        if not exists(dest_dir):
-            makedirs(dest_dir)
-
-        output = wave_open(dest_file, "wb")
+        s = BytesIO()
+        output = wave_open(s, "wb")
         try:
             output.setparams(input.getparams())
             output.setnchannels(nchannels)
@@ -522,6 +583,7 @@ def copy_wave(src, dest):
             output.writeframes(frames)
         finally:
             output.close()
+        write_output(dest, s.getvalue())
     finally:
         input.close()
 
@@ -559,20 +621,21 @@ def copy_sound_asset(sounds, asset, modifier):
 def fix_sounds(visuals):
     # get sound list
     sounds = KVList()
-    for root, _, files in chain(walk(dota_file("sound")), walk(dota_file("scripts"))):
-        for f in files:
-            if not (f.startswith("game_sounds") and f.endswith(".txt")):
-                continue
-            if f.endswith("_phonemes.txt"):
-                continue
-            if f.endswith("_manifest.txt"):
-                continue
-            with open(join(root, f), "rt", encoding="utf-8") as s:
-                part_sounds = load(s)
-            sounds.update(list(part_sounds))
+    record_input("listing", "sound")
+    record_input("listing", "scripts")
+    for p in dota_files.files_in("sound") + dota_files.files_in("scripts"):
+        f = basename(p)
+        if not (f.startswith("game_sounds") and f.endswith(".txt")):
+            continue
+        if f.endswith("_phonemes.txt"):
+            continue
+        if f.endswith("_manifest.txt"):
+            continue
+        part_sounds = load_kv(dota_file(p))
+        sounds.update(list(part_sounds))
 
     # fix sound visuals
-    sound_visuals, visuals = filtersplit(visuals, isvisualtype("sound"))
+    sound_visuals = visuals.pop_type("sound")
     for asset, modifier in assetmodifier(sound_visuals):
         if not asset in sounds:
             print("Warning: can't find sound asset {}".format(asset), file=stderr)
@@ -582,7 +645,7 @@ def fix_sounds(visuals):
 
 def fix_hero_icons(visuals):
     # fix hero icon visuals (lina arcana)
-    icon_visuals, visuals = filtersplit(visuals, isvisualtype("icon_replacement"))
+    icon_visuals = visuals.pop_type("icon_replacement")
     for asset, modifier in assetmodifier(icon_visuals):
         prefix = "npc_dota_hero_"
         if asset.startswith(prefix):
@@ -598,7 +661,7 @@ def fix_hero_icons(visuals):
 
 def fix_ability_icons(visuals):
     # fix spell icon visuals (lina arcana)
-    ability_icon_visuals, visuals = filtersplit(visuals, isvisualtype("ability_icon"))
+    ability_icon_visuals = visuals.pop_type("ability_icon")
     for asset, modifier in assetmodifier(ability_icon_visuals):
         image_dir = "resource/flash3/images/spellicons"
         copy(image_dir + "/" + asset + ".png", image_dir + "/" + modifier + ".png")
@@ -607,24 +670,19 @@ def fix_ability_icons(visuals):
 
 def get_units():
     # get unit model list
-    with open(dota_file("scripts/npc/npc_units.txt"), "rt", encoding="utf-8") as input:
-        units = load(input)
+    units = load_kv(dota_file("scripts/npc/npc_units.txt"))
     return units
 
-def fix_summons(visuals, units, d, default_ids):
+def fix_summons(visuals, units, items_game):
     # get default entity_model (tiny's tree)
     default_entity_models = {}
-    for default_id in default_ids:
-        item = get_item(d, default_id)
-        if "visuals" in item:
-            for k, v in item["visuals"]:
-                if isvisualtype("entity_model")((default_id, k, v)):
-                    asset = v["asset"]
-                    modifier = v["modifier"]
-                    default_entity_models[asset] = modifier
+    for default_id, k, v in items_game.visuals_of_type("entity_model", items_game.default_ids):
+        asset = v["asset"]
+        modifier = v["modifier"]
+        default_entity_models[asset] = modifier
 
     # fix summon overrides
-    entity_model_visuals, visuals = filtersplit(visuals, isvisualtype("entity_model"))
+    entity_model_visuals = visuals.pop_type("entity_model")
     for asset, modifier in assetmodifier(entity_model_visuals):
         asset_model = None
         npc = units["DOTAUnits"].get(asset)
@@ -648,17 +706,15 @@ def fix_summons(visuals, units, d, default_ids):
 
 def fix_base_models(visuals, heroes):
     # fix hero base model overrides (TB arcana)
-    entity_model_visuals, visuals = filtersplit(visuals, isvisualtype("base_model"))
+    entity_model_visuals = visuals.pop_type("base_model")
     for asset, modifier in assetmodifier(entity_model_visuals):
         asset_model = heroes["DOTAHeroes"][asset]["Model"]
         copy_model(asset_model, modifier)
         # special case to fix mismatched activities
         if modifier == "models/heroes/crystal_maiden/crystal_maiden_arcana.mdl":
             print("Applying activity fix to crystal_maiden_arcana.mdl")
-            f = nohats_file(modifier)
-            m = MDL()
-            with open(f, "rb") as s:
-                m.unpack(s)
+            f = edit_file(modifier)
+            m = mdl_cache.take(f)
             for seq in m["localsequence"]:
                 if seq["labelindex"].data[1] == "cm_attack2" and seq["activitynameindex"].data[1] == "ACT_DOTA_ATTACK" and len(seq["activitymodifier"]) == 0:
                     sequence = seq
@@ -685,7 +741,7 @@ def fix_base_models(visuals, heroes):
 
 def fix_hero_forms(visuals):
     # fix hero model overrides
-    hero_visuals, visuals = filtersplit(visuals, isvisualtype("hero_model_change"))
+    hero_visuals = visuals.pop_type("hero_model_change")
     for asset, modifier in assetmodifier(hero_visuals):
         copy_model(asset, modifier)
 
@@ -693,7 +749,7 @@ def fix_hero_forms(visuals):
 
 def fix_particle_snapshots(visuals):
     # fix particle snapshots
-    psf_visuals, visuals = filtersplit(visuals, isvisualtype("particle_snapshot"))
+    psf_visuals = visuals.pop_type("particle_snapshot")
     for asset, modifier in assetmodifier(psf_visuals):
         copy(asset, modifier)
 
@@ -701,7 +757,7 @@ def fix_particle_snapshots(visuals):
 
 def fix_couriers(visuals, units, courier_model):
     couriers = []
-    courier_visuals, visuals = filtersplit(visuals, isvisualtype("courier"))
+    courier_visuals = visuals.pop_type("courier")
     for asset, modifier in assetmodifier(courier_visuals):
         if modifier not in couriers:
             couriers.append(modifier)
@@ -711,7 +767,7 @@ def fix_couriers(visuals, units, courier_model):
 
 def fix_flying_couriers(visuals, units, flying_courier_model):
     couriers = []
-    flying_courier_visuals, visuals = filtersplit(visuals, isvisualtype("courier_flying"))
+    flying_courier_visuals = visuals.pop_type("courier_flying")
     for asset, modifier in assetmodifier(flying_courier_visuals):
         if modifier not in couriers:
             couriers.append(modifier)
@@ -721,16 +777,15 @@ def fix_flying_couriers(visuals, units, flying_courier_model):
     return visuals
 
 def get_npc_heroes():
-    with open(dota_file("scripts/npc/npc_heroes.txt"), "rt", encoding="utf-8") as input:
-        npc_heroes = load(input)
+    npc_heroes = load_kv(dota_file("scripts/npc/npc_heroes.txt"))
     return npc_heroes
 
-def fix_animations(d, visuals, npc_heroes):
+def fix_animations(visuals, npc_heroes):
     ignored = ["ACT_DOTA_STATUE_SEQUENCE", "ACT_DOTA_STAUTE_SEQUENCE"]
 
     item_activity_modifiers = set()
 
-    activity_visuals, visuals = filtersplit(visuals, isvisualtype("activity"))
+    activity_visuals = visuals.pop_type("activity")
     for id, key, visual in activity_visuals:
         asset, modifier = assetmodifier1(visual)
         item_activity_modifiers.add(modifier)
@@ -739,12 +794,10 @@ def fix_animations(d, visuals, npc_heroes):
         if k == "Version":
             continue
         model = v["Model"]
-        if not exists(source_file(model)):
+        if not source_exists(model):
             continue
 
-        model_parsed = MDL()
-        with open(source_file(model), "rb") as s:
-            model_parsed.unpack(s)
+        model_parsed = mdl_cache.load(source_file(model))
 
         sequence_dict = OrderedDict()
         for sequence in model_parsed["localsequence"]:
@@ -774,7 +827,7 @@ def fix_animations(d, visuals, npc_heroes):
                 print("Replace sequence {} with {}".format(sequence["labelindex"].data[1], orig_seq and orig_seq["labelindex"].data[1]))
                 if nohats_dir is None:
                     continue
-                with open(nohats_file(model), "r+b") as s:
+                with open(edit_file(model), "r+b") as s:
                     new_seq = LocalSequence()
                     new_seq.data = orig_seq.data
                     new_seq["labelindex"].data = sequence["labelindex"].data
@@ -798,9 +851,9 @@ def get_particlesystems(item):
                     pss.append(system_name)
     return pss
 
-def get_particle_replacements(d, defaults, visuals, default_ids):
+def get_particle_replacements(items_game, visuals):
     particle_attachments = OrderedDict()
-    for k, v in d["items_game"]["attribute_controlled_attached_particles"]:
+    for k, v in items_game.attached_particles:
         name = v["system"].lower()
         attach_type = v["attach_type"]
         attach_entity = v["attach_entity"]
@@ -823,27 +876,27 @@ def get_particle_replacements(d, defaults, visuals, default_ids):
             particle_replacements[system] = default_system
 
     default_particlesystems = set()
-    for id, item in d["items_game"]["items"]:
-        if not id in default_ids:
+    for id, item in items_game.items:
+        if not id in items_game.default_ids:
             continue
         for ps in get_particlesystems(item):
             default_particlesystems.add(ps)
 
-    particle_visuals, visuals = filtersplit(visuals, isvisualtype("particle"))
+    particle_visuals = visuals.pop_type("particle")
     for id, k, v in particle_visuals:
         asset, modifier = assetmodifier1(v)
         add_replacement(modifier.lower(), asset.lower())
 
-    particle_combined_visuals, visuals = filtersplit(visuals, isvisualtype("particle_combined"))
+    particle_combined_visuals = visuals.pop_type("particle_combined")
     for id, k, v in particle_combined_visuals:
         asset, modifier = assetmodifier1(v)
         add_replacement(modifier.lower(), asset.lower())
 
-    for id, item in d["items_game"]["items"]:
-        if id == "default" or id in default_ids:
+    for id, item in items_game.items:
+        if id == "default" or id in items_game.default_ids:
             continue
 
-        default_item = get_default_item(d, defaults, item)
+        default_item = items_game.default_item(id)
         pss = get_particlesystems(item)
         default_pss = get_particlesystems(default_item)
         if default_pss and pss and len(pss) < len(default_pss):
@@ -869,7 +922,7 @@ def get_particle_replacements(d, defaults, visuals, default_ids):
                 default_ps = None
             add_replacement(ps, default_ps)
 
-    for k, v in d["items_game"]["attribute_controlled_attached_particles"]:
+    for k, v in items_game.attached_particles:
         system_name = v["system"].lower()
         if "resource" in v and v["resource"].startswith("particles/econ/courier/"):
             add_replacement(system_name, None)
@@ -924,14 +977,15 @@ def get_particle_replacements(d, defaults, visuals, default_ids):
 
     return visuals, forwarded_particle_replacements
 
-def get_particle_file_systems(d, units, npc_heroes):
+def parse_particles_manifest(text):
+    # the first key is not quoted
+    l, rest = text.split("\n", 1)
+    return loads("\"" + l + "\"\n" + rest)
+
+def get_particle_file_systems(items_game, units, npc_heroes):
     files = []
 
-    with open(dota_file("particles/particles_manifest.txt"), "rt", encoding="utf-8") as s:
-        l = s.readline().rstrip("\n")
-        l = "\"" + l + "\""
-        l += s.read()
-    m = load(StringIO(l))
+    m = load_kv(dota_file("particles/particles_manifest.txt"), parse_particles_manifest)
     for k, v in m["particles_manifest"]:
         assert k == "file", k
         if v.startswith("!"):
@@ -942,46 +996,47 @@ def get_particle_file_systems(d, units, npc_heroes):
         if "ParticleFile" in item and item["ParticleFile"] not in files:
             files.append(item["ParticleFile"])
 
-    with open(dota_file("scripts/precache.txt"), "rt", encoding="utf-8") as s:
-        p = load(s)
-        for k, v in p["precache"]:
-            if k == "particlefile" and v not in files:
-                files.append(v)
+    p = load_kv(dota_file("scripts/precache.txt"))
+    for k, v in p["precache"]:
+        if k == "particlefile" and v not in files:
+            files.append(v)
 
-    for id, item in d["items_game"]["items"]:
+    for id, item in items_game.items:
         if "particle_file" in item and item["particle_file"] not in files:
             files.append(item["particle_file"])
 
-    for id, v in d["items_game"]["attribute_controlled_attached_particles"]:
+    for id, v in items_game.attached_particles:
         if v.get("resource") is not None and v["resource"] not in files:
             files.append(v["resource"])
 
-    for k, v in d["items_game"]["asset_modifiers"]:
+    for k, v in items_game.asset_modifiers:
         if "file" in v and v["file"] not in files:
             files.append(v["file"])
 
-    particle_file_systems = OrderedDict()
+    existing_files = OrderedDict()
     for file in files:
-        if not exists(source_file(file)):
+        if not source_exists(file):
             print("Warning: referenced particle file '{}' doesn't exist.".format(file), file=stderr)
             continue
+        existing_files[file] = source_file(file)
+    file_systems = system_index.systems(list(existing_files.values()), jobs)
+    system_index.save()
+
+    particle_file_systems = OrderedDict()
+    for file, path in existing_files.items():
         particle_file_systems[file] = []
-        pcf = PCF(include_attributes=False)
-        with open(source_file(file), "rb") as s:
-            pcf.unpack(s)
-        for e in pcf["elements"]:
-            if e["type"].data == "DmeParticleSystemDefinition":
-                system_name = e["name"].data.lower()
-                if system_name not in particle_file_systems[file]:
-                    particle_file_systems[file].append(system_name)
-                else:
-                    print("Warning: double particle system definition '{}' in '{}'".format(system_name, file), file=stderr)
+        for system_name in file_systems[path]:
+            if system_name not in particle_file_systems[file]:
+                particle_file_systems[file].append(system_name)
+            else:
+                print("Warning: double particle system definition '{}' in '{}'".format(system_name, file), file=stderr)
 
     return particle_file_systems
 
-def edit_particle_file(f, file):
+def rewrite_particle_file(f, path, keep):
+    # the contents of path after calling f on each particle system, None if they're not kept
     p = PCF()
-    with open(source_file(file), "rb") as s:
+    with open(path, "rb") as s:
         p.unpack(s)
     p.minimize()
     main_element = p["elements"][0]
@@ -994,21 +1049,54 @@ def edit_particle_file(f, file):
     for i in range(len(psdl)):
         f(psdl, i)
 
-    if nohats_dir:
-        dest = nohats_file(file)
-        dest_dir = dirname(dest)
-        if not exists(dest_dir):
-            makedirs(dest_dir)
-        with open(dest, "wb") as s:
-            p.full_pack(s)
+    if keep:
+        s = BytesIO()
+        p.full_pack(s)
+        return s.getvalue()
     else:
         s = FakeWriteStream()
         p.full_pack(s)
+        return None
 
-def fix_particles(d, defaults, default_ids, visuals, units, npc_heroes):
-    visuals, particle_replacements = get_particle_replacements(d, defaults, visuals, default_ids)
+def edit_particle_file(f, file):
+    data = rewrite_particle_file(f, source_file(file), bool(nohats_dir))
+    if data is not None:
+        write_output(file, data)
+
+def replace_systems(task):
+    # runs in a forked worker process, the task is plain data: the file, what to replace and with what,
+    # and a seed for the guids so they don't depend on which worker gets the file
+    path, replacements, keep, task_seed = task
+    replacements = dict(replacements)
+    # only the replaced systems are encoded again
+    p = RawPCF(Random(task_seed))
+    with open(path, "rb") as s:
+        p.unpack(s)
+    for i in p.root_systems():
+        type, name, guid = p.elements[i]
+        assert type == "DmeParticleSystemDefinition"
+        name = name.lower()
+        if name in replacements:
+            if replacements[name] is None:
+                p.clear_attributes(i)
+            else:
+                replacement_path, replacement_system = replacements[name]
+                o = pcf_cache.load(replacement_path)
+                assert replacement_system in o.systems, "Could not find system {} in file {}".format(replacement_system, replacement_path)
+                p.replace_attributes(i, o, o.systems[replacement_system])
 
-    particle_file_systems = get_particle_file_systems(d, units, npc_heroes)
+            del replacements[name]
+
+    assert not replacements, "Systems {} not found in {}".format(sorted(replacements), path)
+    data = p.pack()
+    if keep:
+        return data
+    return None
+
+def fix_particles(items_game, visuals, units, npc_heroes):
+    visuals, particle_replacements = get_particle_replacements(items_game, visuals)
+
+    particle_file_systems = get_particle_file_systems(items_game, units, npc_heroes)
 
     particlesystem_files = {}
     for file, systems in particle_file_systems.items():
@@ -1040,38 +1128,37 @@ def fix_particles(d, defaults, default_ids, visuals, units, npc_heroes):
             else:
                 file_replacements[file][system] = (default_system_files[0], default_system)
 
+    tasks = []
     for file, replacements in file_replacements.items():
         print("{}:".format(file))
+        task_replacements = []
         for system, replacement in replacements.items():
             if replacement is None:
                 print("\t{} -> None".format(system))
+                task_replacements.append((system, None))
             else:
                 replacement_file, replacement_system = replacement
                 print("\t{} -> {} ({})".format(system, replacement_system, replacement_file))
+                # default systems are never replaced, so the original file has the same ones as a rewritten one
+                task_replacements.append((system, (source_file(replacement_file), replacement_system)))
+        tasks.append((source_file(file), task_replacements, bool(nohats_dir), "{}\0{}".format(seed_num, file)))
 
-        def edit(psdl, i):
-            psd = psdl[i].data
-            assert psd["type"].data == "DmeParticleSystemDefinition"
-            name = psd["name"].data.lower()
-            if name in replacements:
-                if replacements[name] is None:
-                    psd.attribute.data = []
-                else:
-                    replacement_file, replacement_system = replacements[name]
-                    o = PCF()
-                    with open(source_file(replacement_file), "rb") as s:
-                        o.unpack(s)
-                    for e in o["elements"]:
-                        if e["type"].data == "DmeParticleSystemDefinition" and e["name"].data.lower() == replacement_system:
-                            psd.attribute.data = e.attribute.data
-                            break
-                    else:
-                        assert False, "Could not find system {} in file {}".format(replacement_system, replacement_file)
-
-                del replacements[name]
-
-        edit_particle_file(edit, file)
-        assert not replacements
+    # the files are independent, the results are written in order
+    try:
+        # the workers use the caches of this process
+        context = get_context("fork")
+    except ValueError:
+        context = None
+    if jobs > 1 and len(tasks) > 1 and context is not None:
+        with context.Pool(min(jobs, len(tasks))) as pool:
+            for file, data in zip(file_replacements, pool.imap(replace_systems, tasks)):
+                if data is not None:
+                    write_output(file, data)
+    else:
+        for file, task in zip(file_replacements, tasks):
+            data = replace_systems(task)
+            if data is not None:
+                write_output(file, data)
 
     return visuals
 
@@ -1084,16 +1171,14 @@ def fix_skins(courier_model, flying_courier_model):
         "models/heroes/legion_commander/legion_commander.mdl",
         ]
     for model in skins:
-        m = MDL()
-        with open(source_file(model), "rb") as s:
-            m.unpack(s)
+        m = mdl_cache.take(source_file(model))
         assert m["numskinfamilies"] != 1, (model, m["numskinfamilies"])
         for i in range(1, m["numskinfamilies"].data):
             m["skin"].field[i].data = m["skin"].field[0].data
         copy_model_always(model, model)
         if nohats_dir is None:
             continue
-        with open(nohats_file(model), "r+b") as s:
+        with open(edit_file(model), "r+b") as s:
             s.seek(m["skinindex"].data)
             m["skin"].field.pack(s)
 
@@ -1134,8 +1219,6 @@ def fix_particle_color(npc_heroes):
         edit_particle_file(edit, particle_file)
 
 def fix_scaleform():
-    if nohats_dir:
-        makedirs(nohats_file("resource/flash3"))
     fix_scaleform_play()
     fix_scaleform_play_matchmaking_status()
     fix_scaleform_shared_heroselectorandloadout()
@@ -1183,8 +1266,9 @@ def fix_scaleform_play():
             edit_methodbody(abcfile, "MainTimeline", "updateAdPicker", br"\x62\x04\xd1\xad", b"\x02\x02\x02\x27")
 
     if nohats_dir:
-        with open(nohats_file(filename), "wb") as s:
-            swf.pack(s)
+        s = BytesIO()
+        swf.pack(s)
+        write_output(filename, s.getvalue())
 
 def fix_scaleform_play_matchmaking_status():
     filename = "resource/flash3/play_matchmaking_status.gfx"
@@ -1199,8 +1283,9 @@ def fix_scaleform_play_matchmaking_status():
             edit_methodbody(abcfile, "MainTimeline", "setChromeBrowserVisible", br"\xd1", b"\x27")
 
     if nohats_dir:
-        with open(nohats_file(filename), "wb") as s:
-            swf.pack(s)
+        s = BytesIO()
+        swf.pack(s)
+        write_output(filename, s.getvalue())
 
 def fix_scaleform_shared_heroselectorandloadout():
     filename = "resource/flash3/shared_heroselectorandloadout.gfx"
@@ -1215,8 +1300,9 @@ def fix_scaleform_shared_heroselectorandloadout():
             edit_methodbody(abcfile, "MainTimeline", "setSuggestedItems", br"\x26", b"\x27", count=1)
 
     if nohats_dir:
-        with open(nohats_file(filename), "wb") as s:
-            swf.pack(s)
+        s = BytesIO()
+        swf.pack(s)
+        write_output(filename, s.getvalue())
 
 def fix_scaleform_challenges():
     filename = "resource/flash3/challenges.gfx"
@@ -1231,8 +1317,9 @@ def fix_scaleform_challenges():
             edit_methodbody(abcfile, "MainTimeline", "updateStatusSection", br"\xd1\x24\x00\xae", b"\x02\x02\x02\x27", count=1)
 
     if nohats_dir:
-        with open(nohats_file(filename), "wb") as s:
-            swf.pack(s)
+        s = BytesIO()
+        swf.pack(s)
+        write_output(filename, s.getvalue())
 
 def fix_effigies():
     peds = "models/heroes/pedestal/"
@@ -1253,20 +1340,70 @@ def fix_effigies():
     copy_model(ped_dire, peds + "effigy_pedestal_ti5_lv2_dire.mdl")
 
 if __name__ == "__main__":
-    dota_dir = abspath(argv[1])
-    try:
-        nohats_dir = argv[2]
-    except IndexError:
-        nohats_dir = None
-    try:
-        seed_num = int(argv[3])
-    except IndexError:
+    parser = ArgumentParser(description="Override cosmetic files with default files")
+    parser.add_argument("dota_dir", help="Unpacked Dota 2 game files, or where to unpack them with --vpk")
+    parser.add_argument("nohats_dir", nargs="?", help="Output directory, nothing is written if not given")
+    parser.add_argument("seed", nargs="?", type=int, help="Random seed")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--cache-dir", default=environ.get("NOHATS_CACHE_DIR"), help="Cache parsed KeyValues files in this directory")
+    parser.add_argument("--cache-size", type=int, default=int(environ.get("NOHATS_CACHE_SIZE", 256)), metavar="MIB", help="Maximum size of the cache directory")
+    parser.add_argument("--blob-dir", help="Store the contents of output files here, default is nohats_dir with .blobs appended")
+    parser.add_argument("--incremental", action="store_true", help="Update an existing nohats_dir, only running stages whose inputs changed")
+    parser.add_argument("--vpk", metavar="DIR_VPK", help="Read the game files from this pak01_dir.vpk, only unpacking the ones that are used")
+    parser.add_argument("--profile", metavar="JSON_FILE", help="Measure time, memory and I/O of each stage and write them to this file")
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiler = StageProfiler()
+    else:
+        profiler = None
+    dota_dir = abspath(args.dota_dir)
+    jobs = args.jobs
+    nohats_dir = args.nohats_dir
+    seed_num = args.seed
+    if seed_num is None:
         seed_num = randint(0, 2**128 - 1)
+    if args.cache_dir is not None:
+        kv_cache = KVCache(args.cache_dir, args.cache_size * 2**20)
+    else:
+        kv_cache = None
     print("OS: {}".format(os_name))
     print("Python version: {}".format(version))
     print("Seed: {}".format(seed_num))
     seed(seed_num)
     if nohats_dir is not None:
         nohats_dir = abspath(nohats_dir)
-        assert not exists(nohats_dir)
+        assert args.incremental or not exists(nohats_dir)
+        blob_store = BlobStore(abspath(args.blob_dir or nohats_dir + ".blobs"))
+    else:
+        assert not args.incremental, "--incremental needs nohats_dir"
+        blob_store = None
+    if args.vpk is not None:
+        vpk_reader = VPKReader(args.vpk)
+        vpk_extracted = set()
+        dota_files = FileIndex()
+        for p in vpk_reader.entries:
+            dota_files.add(p)
+    else:
+        vpk_reader = None
+        dota_files = FileIndex(dota_dir)
+    nohats_files = FileIndex()
+    copy_plan = CopyPlan(blob_store)
+    mdl_cache = MDLCache()
+    pcf_cache = PCFCache()
+    if blob_store is not None:
+        # the digests of unchanged files are known already
+        digest = blob_store.digest_cache.digest
+    else:
+        digest = file_digest
+    system_index = SystemIndex(join(args.cache_dir, "particle_systems") if args.cache_dir is not None else None, digest)
+    if args.incremental:
+        build_state = BuildState(join(blob_store.blob_dir, "build_state"), build_version())
+        build_state.fingerprints["file"] = blob_store.digest_cache.digest
+        build_state.fingerprints["listing"] = dota_files.files_in
+    else:
+        build_state = None
     nohats()
+    if profiler is not None:
+        header("Profile")
+        profiler.report()
+        profiler.save(args.profile)
@@ -1,10 +1,21 @@
 # Copyright (c) Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
+from atomicfile import atomic_write, atomic_load
 from binary import Struct, Magic, Format, String, Blob, PrefixedBlob, PrefixedArray, Array, Index, FixedString, BaseField
 import json
+from collections import OrderedDict
+from marshal import dumps as marshal_dumps
+from multiprocessing import Pool
+from os import stat
 from uuid import UUID
-from random import randint
+import random
+import struct
+from struct import pack, unpack_from
+
+def new_guid_bytes(generator=random):
+    random_bytes = bytes([generator.randint(0, 255) for i in range(16)])
+    return UUID(bytes=random_bytes, version=4).bytes
 
 class UUIDField(Blob):
     def __init__(self):
@@ -101,9 +112,7 @@ class Element(Struct):
         return hash(self.__key())
 
     def new_guid(self):
-        random_bytes = bytes([randint(0, 255) for i in range(16)])
-        uuid = UUID(bytes=random_bytes, version=4)
-        self["guid"].data = uuid.urn
+        self["guid"].data = UUID(bytes=new_guid_bytes()).urn
 
 class PCF(Struct):
     def fields(self, include_attributes=True):
@@ -144,6 +153,307 @@ class PCF(Struct):
         self["attributes"].data = [self["attributes"].data[0]]
         self["elements"][0].attribute = self["attributes"][0]
 
+# sizes of the attribute types that don't refer to elements or strings
+value_sizes = {
+    2: 4, # integer
+    3: 4, # float
+    4: 1, # bool
+    7: 4, # time
+    8: 4, # color
+    9: 8, # vector2
+    10: 12, # vector3
+    11: 16, # vector4
+    12: 12, # angle
+    13: 16, # quaternion
+    14: 64, # matrix
+}
+
+class RawPCF(object):
+    # a particle file that is only decoded as far as needed to change some systems,
+    # the rest of it is copied as it is
+    def __init__(self, generator=random):
+        # for the guids of copied elements
+        self.generator = generator
+
+    def unpack(self, s):
+        self.raw = s.read()
+        raw = self.raw
+        magic = b"<!-- dmx encoding "
+        assert raw.startswith(magic)
+        pos = len(magic)
+        version = raw[pos:pos+len("binary 2 format pcf 1")].decode()
+        assert version in ["binary 2 format pcf 1", "binary 5 format pcf 2"], version
+        pos += len(version)
+        assert raw[pos:pos+len(b" -->\n\0")] == b" -->\n\0"
+        self.header_end = pos + len(b" -->\n\0")
+        # newer versions refer to the string table for all strings
+        self.wide = version == "binary 5 format pcf 2"
+        self.index_format = struct.Struct("<I" if self.wide else "<h")
+
+        pos = self.header_end
+        n, = self.index_format.unpack_from(raw, pos)
+        pos += self.index_format.size
+        self.strings = []
+        for i in range(n):
+            end = raw.index(b"\0", pos)
+            self.strings.append(raw[pos:end].decode())
+            pos = end + 1
+        self.string_indexes = dict((v, i) for i, v in reversed(list(enumerate(self.strings))))
+
+        n, = unpack_from("<I", raw, pos)
+        pos += 4
+        # (type, name, guid) of each element
+        self.elements = []
+        # start and end of each element in raw
+        self.element_ranges = []
+        for i in range(n):
+            start = pos
+            type, = self.index_format.unpack_from(raw, pos)
+            pos += self.index_format.size
+            name, pos = self.read_string(pos)
+            self.elements.append((self.strings[type], name, raw[pos:pos+16]))
+            pos += 16
+            self.element_ranges.append((start, pos))
+
+        # start and end of the attributes of each element in raw
+        self.attribute_ranges = []
+        for i in range(n):
+            start = pos
+            count, = unpack_from("<I", raw, pos)
+            pos += 4
+            for j in range(count):
+                pos += self.index_format.size
+                type = raw[pos]
+                pos = self.skip_value(type, pos + 1)
+            self.attribute_ranges.append((start, pos))
+        assert pos == len(raw), "Trailing data after the attributes"
+
+        # lowercase name -> index of the first system with that name
+        self.systems = {}
+        for i, (type, name, guid) in enumerate(self.elements):
+            if type == "DmeParticleSystemDefinition":
+                self.systems.setdefault(name.lower(), i)
+        # element index -> new attributes
+        self.new_attributes = {}
+        # (other file, element index) -> index in this file, the key keeps the other file alive
+        self.copied = {}
+        self.new_elements = []
+
+    def read_string(self, pos):
+        if self.wide:
+            index, = self.index_format.unpack_from(self.raw, pos)
+            return self.strings[index], pos + self.index_format.size
+        end = self.raw.index(b"\0", pos)
+        return self.raw[pos:end].decode(), end + 1
+
+    def skip_value(self, type, pos):
+        if type > 14:
+            count, = unpack_from("<I", self.raw, pos)
+            pos += 4
+            type -= 14
+        else:
+            count = 1
+        if type == 1:
+            return pos + 4 * count
+        if type in value_sizes:
+            return pos + value_sizes[type] * count
+        for i in range(count):
+            if type == 5:
+                pos = self.read_string(pos)[1]
+            elif type == 6:
+                size, = unpack_from("<I", self.raw, pos)
+                pos += 4 + size
+            else:
+                assert False, type
+        return pos
+
+    def attributes(self, i):
+        # [(name, type, data)] of element i, where data is element indexes and strings,
+        # or the bytes of the other types
+        raw = self.raw
+        pos = self.attribute_ranges[i][0]
+        count, = unpack_from("<I", raw, pos)
+        pos += 4
+        attributes = []
+        for j in range(count):
+            name, = self.index_format.unpack_from(raw, pos)
+            pos += self.index_format.size
+            type = raw[pos]
+            pos += 1
+            start = pos
+            if type == 1:
+                data, = unpack_from("<i", raw, pos)
+                pos += 4
+            elif type == 15:
+                n, = unpack_from("<I", raw, pos)
+                data = list(unpack_from("<{}i".format(n), raw, pos + 4))
+                pos += 4 + 4 * n
+            elif type == 5:
+                data, pos = self.read_string(pos)
+            elif type == 19:
+                n, = unpack_from("<I", raw, pos)
+                pos += 4
+                data = []
+                for k in range(n):
+                    v, pos = self.read_string(pos)
+                    data.append(v)
+            else:
+                pos = self.skip_value(type, pos)
+                data = raw[start:pos]
+            attributes.append((self.strings[name], type, data))
+        return attributes
+
+    def root_systems(self):
+        # indexes of the elements in the particle system list of the root element
+        type, name, guid = self.elements[0]
+        assert type == "DmElement"
+        attributes = self.attributes(0)
+        assert len(attributes) == 1
+        name, type, data = attributes[0]
+        assert name == "particleSystemDefinitions"
+        assert type == 15
+        return data
+
+    def string_index(self, s):
+        if s not in self.string_indexes:
+            self.string_indexes[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index_format.pack(self.string_indexes[s])
+
+    def pack_string(self, s):
+        if self.wide:
+            return self.string_index(s)
+        return s.encode() + b"\0"
+
+    def clear_attributes(self, i):
+        self.new_attributes[i] = pack("<I", 0)
+
+    def replace_attributes(self, i, other, j):
+        # copy the attributes of element j of other to element i, with the elements they refer to
+        self.new_attributes[i] = self.pack_attributes(other, j)
+
+    def copy_element(self, other, j):
+        if j < 0:
+            return j
+        key = (other, j)
+        if key not in self.copied:
+            # the index is taken first, elements can refer to each other
+            self.copied[key] = len(self.elements) + len(self.new_elements)
+            type, name, guid = other.elements[j]
+            element = [self.string_index(type) + self.pack_string(name) + new_guid_bytes(self.generator), None]
+            self.new_elements.append(element)
+            element[1] = self.pack_attributes(other, j)
+        return self.copied[key]
+
+    def pack_attributes(self, other, j):
+        attributes = other.attributes(j)
+        l = [pack("<I", len(attributes))]
+        for name, type, data in attributes:
+            l.append(self.string_index(name))
+            l.append(pack("<B", type))
+            if type == 1:
+                l.append(pack("<i", self.copy_element(other, data)))
+            elif type == 15:
+                l.append(pack("<I{}i".format(len(data)), len(data), *[self.copy_element(other, k) for k in data]))
+            elif type == 5:
+                l.append(self.pack_string(data))
+            elif type == 19:
+                l.append(pack("<I", len(data)))
+                l.extend(self.pack_string(v) for v in data)
+            else:
+                l.append(data)
+        return b"".join(l)
+
+    def pack(self):
+        raw = self.raw
+        l = [raw[:self.header_end]]
+        l.append(self.index_format.pack(len(self.strings)))
+        l.extend(v.encode() + b"\0" for v in self.strings)
+        l.append(pack("<I", len(self.elements) + len(self.new_elements)))
+        l.extend(raw[start:end] for start, end in self.element_ranges)
+        l.extend(element for element, attributes in self.new_elements)
+        for i, (start, end) in enumerate(self.attribute_ranges):
+            if i in self.new_attributes:
+                l.append(self.new_attributes[i])
+            else:
+                l.append(raw[start:end])
+        l.extend(attributes for element, attributes in self.new_elements)
+        return b"".join(l)
+
+class PCFCache(object):
+    # particle files that systems are copied from, each read once
+    def __init__(self, max_bytes=2**26):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # path -> ((size, modification time), RawPCF)
+        self.files = OrderedDict()
+
+    def load(self, path):
+        # shared with other users, so only copy from it
+        st = stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        entry = self.files.get(path)
+        if entry is not None and entry[0] == key:
+            self.files.move_to_end(path)
+            return entry[1]
+        self.invalidate(path)
+        p = RawPCF()
+        with open(path, "rb") as s:
+            p.unpack(s)
+        self.files[path] = (key, p)
+        self.size += st.st_size
+        while self.size > self.max_bytes and len(self.files) > 1:
+            old_path, (old_key, old_p) = self.files.popitem(last=False)
+            self.size -= old_key[0]
+        return p
+
+    def invalidate(self, path):
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            self.size -= entry[0][0]
+
+def system_names(path):
+    # lowercase names of the particle systems defined in path, in order and with duplicates
+    p = PCF(include_attributes=False)
+    with open(path, "rb") as s:
+        p.unpack(s)
+    return [e["name"].data.lower() for e in p["elements"] if e["type"].data == "DmeParticleSystemDefinition"]
+
+class SystemIndex(object):
+    # the particle systems of each file contents, files are only scanned again when their digest changes
+    def __init__(self, index_file, digest):
+        self.index_file = index_file
+        # path -> digest, like DigestCache.digest
+        self.digest = digest
+        # digest -> system names
+        self.entries = {}
+        if index_file is not None:
+            self.entries = atomic_load(index_file, {})
+
+    def systems(self, paths, processes=1):
+        # path -> system names, for every path
+        digests = dict((path, self.digest(path)) for path in paths)
+        # only what is used now is kept
+        entries = dict((h, self.entries[h]) for h in digests.values() if h in self.entries)
+        changed = {}
+        for path, h in digests.items():
+            if h not in entries and h not in changed.values():
+                changed[path] = h
+        if processes > 1 and len(changed) > 1:
+            with Pool(min(processes, len(changed))) as pool:
+                names = pool.map(system_names, changed)
+        else:
+            names = [system_names(path) for path in changed]
+        for h, n in zip(changed.values(), names):
+            entries[h] = n
+        self.entries = entries
+        return dict((path, entries[h]) for path, h in digests.items())
+
+    def save(self):
+        if self.index_file is None:
+            return
+        atomic_write(self.index_file, marshal_dumps(self.entries))
+
 if __name__ == "__main__":
     import json
     p = PCF()
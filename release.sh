@@ -6,6 +6,7 @@ set -e
 set -x
 
 rm -r dota2_nohats || true
+rm -r dota2_nohats.blobs || true
 rm dota2_nohats.7z || true
 rm -r nohats || true
 rm -r dota || true
@@ -21,6 +22,6 @@ pypy3 vpk.py a nohats/pak01 dota2_nohats/
 mkdir dota
 cp gameinfo.txt dota/gameinfo.txt
 
-7z a -mx -ms=off dota2_nohats.7z nohats dota nohats_log.txt readme.txt > /dev/null
+7z a -mx -ms=off dota2_nohats.7z nohats dota nohats_log.txt readme.txt '-x!nohats/pak01_hashes' > /dev/null
 
 times
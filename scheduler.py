@@ -0,0 +1,204 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+import sys
+import random
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from traceback import format_exc
+
+class Stage(object):
+    # a step of the build, which only has to wait for earlier stages that use the same resources
+    def __init__(self, header, f, writes=(), inputs=()):
+        self.header = header
+        self.f = f
+        self.writes = set(writes)
+        # (kind, name) inputs of the build state that the stage always uses
+        self.inputs = list(inputs)
+
+    def depends_on(self, other):
+        return bool(self.writes & other.writes)
+
+    def run(self):
+        print("== {} ==".format(self.header))
+        self.f()
+
+    def replay(self, state, changes):
+        print("== {} ==".format(self.header))
+        print("Inputs are unchanged, reusing the previous outputs")
+        apply_changes(state, changes)
+
+def stage_deps(stages):
+    return [set(j for j in range(i) if stages[i].depends_on(stages[j])) for i in range(len(stages))]
+
+class Capture(object):
+    # collects writes to stdout and stderr in the order they happen
+    def __init__(self, output, stream):
+        self.output = output
+        self.stream = stream
+
+    def write(self, s):
+        if self.output and self.output[-1][0] == self.stream:
+            self.output[-1] = (self.stream, self.output[-1][1] + s)
+        else:
+            self.output.append((self.stream, s))
+        return len(s)
+
+    def flush(self):
+        pass
+
+def capture_output(output):
+    streams = {id(sys.stdout): Capture(output, 0), id(sys.stderr): Capture(output, 1)}
+    # modules that did 'from sys import stderr' have their own reference
+    for module in list(sys.modules.values()):
+        d = getattr(module, "__dict__", {})
+        for name, v in list(d.items()):
+            if id(v) in streams and name != "__stdout__" and name != "__stderr__":
+                d[name] = streams[id(v)]
+
+def snapshot(state):
+    return [dict.fromkeys(c) if isinstance(c, set) else dict(c) for c in state]
+
+def changes(base, state):
+    # what was added, replaced or removed since the snapshot, by identity
+    l = []
+    for b, c in zip(base, state):
+        if isinstance(c, set):
+            changed = [(k, None) for k in c if k not in b]
+        else:
+            changed = [(k, v) for k, v in c.items() if k not in b or b[k] is not v]
+        removed = [k for k in b if k not in c]
+        l.append((changed, removed))
+    return l
+
+def apply_changes(state, l):
+    for c, (changed, removed) in zip(state, l):
+        for k in removed:
+            if isinstance(c, set):
+                c.discard(k)
+            else:
+                c.pop(k, None)
+        if isinstance(c, set):
+            c.update(k for k, v in changed)
+        else:
+            c.update(changed)
+
+def seed_stage(stage, seed):
+    # each stage gets its own random numbers, whichever process it runs in
+    if seed is not None:
+        random.seed("{}\0{}".format(seed, stage.header))
+
+def run_stage(stage, state, build_state, seed=None):
+    # the stage's inputs and changes, if there is a build state
+    seed_stage(stage, seed)
+    if build_state is None:
+        stage.run()
+        return None, None
+    base = snapshot(state)
+    build_state.start(stage)
+    stage.run()
+    return build_state.finish(), changes(base, state)
+
+def run_worker(stage, state, build_state, seed, conn):
+    output = []
+    base = snapshot(state)
+    capture_output(output)
+    seed_stage(stage, seed)
+    try:
+        if build_state is not None:
+            build_state.start(stage)
+        stage.run()
+        inputs = None if build_state is None else build_state.finish()
+    except BaseException:
+        conn.send((output, None, None, format_exc()))
+    else:
+        conn.send((output, inputs, changes(base, state), None))
+    conn.close()
+
+def replay(output):
+    for stream, s in output:
+        f = [sys.stdout, sys.stderr][stream]
+        f.write(s)
+        # keep stdout and stderr interleaved when they go to the same file
+        f.flush()
+
+def run_stages(stages, jobs, state, build_state=None, untracked=(), seed=None):
+    # state is a list of the dicts and sets the stages change, they are merged back after each stage,
+    # untracked state is merged back from workers as well but isn't part of the build state,
+    # the random generator is seeded from seed for every stage so the number of jobs doesn't matter
+    deps = stage_deps(stages)
+    replays = {}
+    if build_state is not None:
+        replays = build_state.replays(stages, deps)
+    try:
+        context = get_context("fork")
+    except ValueError:
+        jobs = 1
+    if jobs <= 1:
+        for i, stage in enumerate(stages):
+            if i in replays:
+                inputs, l = replays[i]
+                stage.replay(state, l)
+            else:
+                inputs, l = run_stage(stage, state, build_state, seed)
+            if build_state is not None:
+                build_state.store(stage, inputs, l)
+        return
+
+    tracked = len(state)
+    state = state + list(untracked)
+    done = set()
+    # connection -> (stage index, process)
+    running = {}
+    outputs = {}
+    next_output = 0
+    while next_output < len(stages):
+        started = set(i for i, p in running.values())
+        for i in range(len(stages)):
+            if len(running) >= jobs:
+                break
+            if i in done or i in started or not deps[i] <= done:
+                continue
+            if i in replays:
+                output = []
+                capture = Capture(output, 0)
+                inputs, l = replays[i]
+                stdout = sys.stdout
+                sys.stdout = capture
+                try:
+                    stages[i].replay(state, l)
+                finally:
+                    sys.stdout = stdout
+                build_state.store(stages[i], inputs, l)
+                outputs[i] = output
+                done.add(i)
+                continue
+            parent_conn, child_conn = context.Pipe(duplex=False)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            p = context.Process(target=run_worker, args=(stages[i], state, build_state, seed, child_conn))
+            p.start()
+            child_conn.close()
+            running[parent_conn] = (i, p)
+        for conn in (wait(list(running)) if running else []):
+            i, p = running.pop(conn)
+            try:
+                output, inputs, l, error = conn.recv()
+            except EOFError:
+                output, inputs, l, error = [], None, None, "worker exited with code {}".format(p.exitcode)
+            conn.close()
+            p.join()
+            outputs[i] = output
+            if error is not None:
+                for j in range(next_output, i + 1):
+                    if j in outputs:
+                        replay(outputs[j])
+                assert False, "Stage '{}' failed:\n{}".format(stages[i].header, error)
+            apply_changes(state, l)
+            if build_state is not None:
+                build_state.store(stages[i], inputs, l[:tracked])
+            done.add(i)
+        # print output in stage order, whatever order the stages finish in
+        while next_output in outputs:
+            replay(outputs.pop(next_output))
+            next_output += 1
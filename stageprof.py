@@ -0,0 +1,90 @@
+# Copyright (c) Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+import builtins
+from json import dump
+from platform import python_implementation, python_version
+from time import perf_counter, process_time
+try:
+    import tracemalloc
+    tracemalloc.reset_peak
+except (ImportError, AttributeError):
+    # not available on PyPy
+    tracemalloc = None
+
+original_open = builtins.open
+
+def io_counters():
+    # bytes read and written by this process, including the page cache
+    try:
+        with original_open("/proc/self/io", "rt") as s:
+            d = dict(line.split(": ") for line in s.read().splitlines())
+        return int(d["rchar"]), int(d["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+class StageProfiler(object):
+    # time, memory and I/O of each stage between two headers
+    def __init__(self):
+        # stage name -> measurements
+        self.stages = {}
+        self.current = None
+        self.started = perf_counter()
+        self.files_read = 0
+        self.files_written = 0
+        if tracemalloc is not None:
+            tracemalloc.start()
+        def counting_open(file, mode="r", *args, **kwargs):
+            if any(c in mode for c in "wax+"):
+                self.files_written += 1
+            else:
+                self.files_read += 1
+            return original_open(file, mode, *args, **kwargs)
+        builtins.open = counting_open
+
+    def start(self, name):
+        self.finish()
+        if tracemalloc is not None:
+            tracemalloc.reset_peak()
+        self.current = (name, perf_counter(), process_time(), self.files_read, self.files_written, io_counters())
+
+    def finish(self):
+        if self.current is None:
+            return
+        name, wall, cpu, files_read, files_written, (bytes_read, bytes_written) = self.current
+        self.current = None
+        new_bytes_read, new_bytes_written = io_counters()
+        self.stages[name] = {
+            "wall": perf_counter() - wall,
+            "cpu": process_time() - cpu,
+            "peak_memory": tracemalloc.get_traced_memory()[1] if tracemalloc is not None else None,
+            "files_read": self.files_read - files_read,
+            "files_written": self.files_written - files_written,
+            "bytes_read": new_bytes_read - bytes_read if bytes_read is not None else None,
+            "bytes_written": new_bytes_written - bytes_written if bytes_written is not None else None,
+            }
+
+    def wrap(self, name, f):
+        def profiled():
+            self.start(name)
+            try:
+                f()
+            finally:
+                self.finish()
+        return profiled
+
+    def report(self):
+        def mib(n):
+            return "-" if n is None else "{:.1f}".format(n / 2**20)
+        print("{:40} {:>8} {:>8} {:>9} {:>7} {:>7} {:>9} {:>9}".format("stage", "wall s", "cpu s", "peak MiB", "files r", "files w", "read MiB", "write MiB"))
+        for name, m in self.stages.items():
+            print("{:40} {:8.2f} {:8.2f} {:>9} {:7} {:7} {:>9} {:>9}".format(name[:40], m["wall"], m["cpu"], mib(m["peak_memory"]), m["files_read"], m["files_written"], mib(m["bytes_read"]), mib(m["bytes_written"])))
+        print("{:40} {:8.2f}".format("total", perf_counter() - self.started))
+
+    def save(self, path):
+        with open(path, "wt", encoding="utf-8") as s:
+            dump({
+                "python": "{} {}".format(python_implementation(), python_version()),
+                "wall": perf_counter() - self.started,
+                "stages": self.stages,
+                }, s, indent=4)
@@ -1,7 +1,17 @@
 # Copyright (c) Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from kvlist import KVList
+from kvlist import KVList, to_plain, from_plain
+from re import compile as re_compile, DOTALL
+from io import StringIO
+from sys import intern
+from gc import isenabled, enable, disable
+from contextlib import contextmanager
+from array import array
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+from multiprocessing import Pool, cpu_count
+from marshal import dumps as marshal_dumps, loads as marshal_loads
 
 def skip_space(s):
     while True:
@@ -29,7 +39,7 @@ def getstring(s):
         lc.append(c)
     return "".join(lc)
 
-def load(s):
+def load_stream(s):
     items = KVList()
     while True:
         c = skip_space(s)
@@ -56,7 +66,7 @@ def parse_dict(s, context):
     return d
 
 def parse_item(s, context):
-    k = getstring(s)
+    k = intern(getstring(s))
     c = skip_space(s)
     if c == '"':
         v = getstring(s)
@@ -66,6 +76,262 @@ def parse_item(s, context):
         assert False, "Expected a string or a dict, got '{}' in {}".format(c, repr(context))
     return k, v
 
+space_re = r'(?:\s+|/[^\n]*(?![^\n]))*'
+string_re = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
+# a key with a string value, a key with an opening brace, a closing brace or the end
+item_re = re_compile(space_re + r'(?:' + string_re + space_re + r'(?:' + string_re + r'|(\{))|(\})|\Z)', DOTALL)
+# everything up to the next brace that is not in a string or a comment
+# (?=(...))\1 doesn't backtrack, so a missing brace fails in linear time
+brace_re = re_compile(r'(?:(?=([^"/{}]+))\1|"[^"\\]*(?:\\.[^"\\]*)*"|/[^\n]*(?![^\n]))*([{}])', DOTALL)
+
+def unescape(v):
+    if "\\" in v:
+        v = v.replace('\\"', '"')
+    return v
+
+def syntax_error(text):
+    # the character based parser gives the better error message
+    load_stream(StringIO(text))
+    assert False, "Syntax error not found by load_stream"
+
+def scan_blocks(text):
+    # positions after every opening brace and after the matching closing brace
+    match = brace_re.match
+    opens = array("l")
+    closes = array("l")
+    stack = []
+    pos = 0
+    while True:
+        m = match(text, pos)
+        if m is None:
+            break
+        pos = m.end()
+        if m.group(2) == "{":
+            stack.append(len(opens))
+            opens.append(pos)
+            closes.append(0)
+        elif stack:
+            closes[stack.pop()] = pos
+        else:
+            syntax_error(text)
+    if stack:
+        syntax_error(text)
+    return opens, closes
+
+class LazyKVList(KVList):
+    # a block that is parsed when it is first used
+    __slots__ = ("span",)
+
+    def __init__(self, text, pos, blocks):
+        self.span = (text, pos, blocks)
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set yet
+        if name in KVList.__slots__:
+            self.materialize()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def materialize(self, parts=None):
+        # parts are to_plain lists of the items, if they were already parsed elsewhere
+        text, pos, blocks = self.span
+        del self.span
+        KVList.__init__(self)
+        with gc_paused():
+            if parts is None:
+                parse(text, pos, self, blocks)
+            else:
+                for part in parts:
+                    for k, v in from_plain(part):
+                        self[k] = v
+
+@contextmanager
+def gc_paused():
+    # parsed trees have no cycles, so don't let the garbage collector scan them while they grow
+    gc_was_enabled = isenabled()
+    disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            enable()
+
+def load(s, lazy=False, processes=None):
+    if processes is not None:
+        return loads_parallel(s.read(), processes)
+    return loads(s.read(), lazy)
+
+def loads(text, lazy=False):
+    if lazy:
+        blocks = scan_blocks(text)
+    else:
+        blocks = None
+    with gc_paused():
+        return parse(text, blocks=blocks)
+
+def parse(text, pos=0, items=None, blocks=None):
+    # without items, parse the top level, otherwise the contents of the block starting at pos
+    # with blocks from scan_blocks, nested blocks are parsed lazily
+    if items is None:
+        items = KVList()
+        toplevel = True
+    else:
+        toplevel = False
+    match = item_re.match
+    d = items
+    stack = []
+    while True:
+        m = match(text, pos)
+        if m is None:
+            syntax_error(text)
+        pos = m.end()
+        k, v, o, c = m.groups()
+        if v is not None:
+            d[intern(unescape(k))] = unescape(v)
+        elif o is not None:
+            if blocks is not None:
+                d[intern(unescape(k))] = LazyKVList(text, pos, blocks)
+                opens, closes = blocks
+                pos = closes[bisect_left(opens, pos)]
+            else:
+                child = KVList()
+                d[intern(unescape(k))] = child
+                stack.append(d)
+                d = child
+        elif c is not None:
+            if stack:
+                d = stack.pop()
+            elif toplevel:
+                syntax_error(text)
+            else:
+                break
+        else:
+            if stack or not toplevel:
+                syntax_error(text)
+            break
+    return items
+
+def split_block(text, pos, blocks, size):
+    # split the contents of the block starting at pos into ranges of whole items of about size characters
+    match = item_re.match
+    opens, closes = blocks
+    ranges = []
+    start = pos
+    while True:
+        m = match(text, pos)
+        if m is None:
+            syntax_error(text)
+        if m.group(3) is not None:
+            end = closes[bisect_left(opens, m.end())]
+        elif m.group(2) is not None:
+            end = m.end()
+        elif m.group(4) is not None:
+            ranges.append((start, m.start(4)))
+            return ranges
+        else:
+            syntax_error(text)
+        if end - start >= size:
+            ranges.append((start, end))
+            start = end
+        pos = end
+
+def parse_plain(text):
+    # marshal is much faster than pickling the KVList objects
+    with gc_paused():
+        return marshal_dumps(to_plain(parse(text)))
+
+def loads_parallel(text, processes=None):
+    # parse the items of the second-level blocks in a process pool
+    if processes is None:
+        processes = cpu_count()
+    blocks = scan_blocks(text)
+    size = max(len(text) // (processes * 4), 2**16)
+    with gc_paused():
+        items = parse(text, blocks=blocks)
+    sections = []
+    tasks = []
+    for k, v in items:
+        if isinstance(v, KVList):
+            for section_k, section_v in v:
+                if isinstance(section_v, LazyKVList):
+                    text, pos, blocks = section_v.span
+                    ranges = split_block(text, pos, blocks, size)
+                    sections.append((section_v, len(ranges)))
+                    tasks.extend(text[start:end] for start, end in ranges)
+    with Pool(processes) as pool:
+        results = pool.imap(parse_plain, tasks)
+        for section, n in sections:
+            section.materialize(marshal_loads(next(results)) for i in range(n))
+    return items
+
+def iterparse(s, chunk_size=2**16):
+    # yields ("enter", path, key, None), ("value", path, key, value) and ("exit", path, key, None)
+    # where path is a tuple of the keys of the enclosing blocks
+    match = item_re.match
+    path = ()
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        m = match(buf, pos)
+        # a match that reaches the end of the buffer might continue in the next chunk
+        if not eof and (m is None or m.end() == len(buf)):
+            chunk = s.read(chunk_size)
+            buf = buf[pos:] + chunk
+            pos = 0
+            eof = chunk == ""
+            continue
+        assert m is not None, "Syntax error at '{}' in {}".format(buf[pos:pos+40].strip(), list(path))
+        pos = m.end()
+        k, v, o, c = m.groups()
+        if v is not None:
+            yield ("value", path, unescape(k), unescape(v))
+        elif o is not None:
+            k = unescape(k)
+            yield ("enter", path, k, None)
+            path += (k,)
+        elif c is not None:
+            assert path, "Unexpected character '}'"
+            k = path[-1]
+            path = path[:-1]
+            yield ("exit", path, k, None)
+        else:
+            assert not path, "Unexpected EOF in {}".format(list(path))
+            return
+
+def iterfind(s, patterns, chunk_size=2**16):
+    # yields (path, key, value) for every key that matches one of the patterns,
+    # e.g. "items_game/items/*", with the whole subtree as value for blocks
+    patterns_by_depth = {}
+    for pattern in patterns:
+        pattern = pattern.split("/")
+        patterns_by_depth.setdefault(len(pattern), []).append(pattern)
+
+    def matches(path, key):
+        for pattern in patterns_by_depth.get(len(path) + 1, []):
+            if all(fnmatchcase(k, p) for k, p in zip(path + (key,), pattern)):
+                return True
+        return False
+
+    stack = []
+    for event, path, key, value in iterparse(s, chunk_size):
+        if stack:
+            if event == "value":
+                stack[-1][key] = value
+            elif event == "enter":
+                child = KVList()
+                stack[-1][key] = child
+                stack.append(child)
+            else:
+                d = stack.pop()
+                if not stack:
+                    yield (path, key, d)
+        elif event != "exit" and matches(path, key):
+            if event == "value":
+                yield (path, key, value)
+            else:
+                stack.append(KVList())
+
 def indent(i, s):
     for j in range(i):
         s.write("\t")
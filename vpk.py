@@ -1,114 +1,180 @@
-from vpklib import VPK
+from atomicfile import atomic_write, atomic_load
+from fileindex import canonical_file
+from vpklib import VPK, VPKReader, read_directory, write_directory
 
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 from json import dumps
-from os import walk
+from marshal import dumps as marshal_dumps
+from os import walk, stat
 from os.path import relpath, join
 from sys import argv
+from threading import local
 from zlib import crc32
 
 def test_vpk(f):
-    assert f.endswith("_dir.vpk")
-    prefix = f[0:-len("_dir.vpk")]
-
-    v = VPK()
-    with open(prefix+"_dir.vpk", "rb") as s:
-        v.unpack(s)
-
-    for ft in v["index"]:
-        for p in ft["directory"]:
-            for f in p["file"]:
-                print("File {}/{}.{}".format(p["path"].data, f["filename"].data, ft["type"].data))
-                if f["archive_index"].data == 0x7FFF:
-                    archive_file = "{}_dir.vpk".format(prefix)
-                    o = f["archive_offset"].data + v["index_size"].data + 12
-                else:
-                    archive_file = "{}_{:03}.vpk".format(prefix, f["archive_index"].data)
-                    o = f["archive_offset"].data
-                n = f["archive_size"].data
-                print("Archive {} offset {} size {}".format(archive_file, o, n))
-                with open(archive_file, "rb") as s:
-                    s.seek(o)
-                    d = s.read(n)
-                    assert len(d) == n, (len(d), n)
-                d = f["preload_data"].data + d
-                my_crc = crc32(d) & 0xFFFFFFFF
-                print("CRC {} = {}, {}".format(my_crc, f["crc"].data, my_crc == f["crc"].data))
-
-def canonical_file(p):
-    return p.lower().replace("\\", "/")
-
-def create_vpk(prefix, pack_dir):
+    r = VPKReader(f)
+    for path, (archive_index, offset, size, crc, preload) in r.entries.items():
+        print("File {}".format(path))
+        print("Archive {} offset {} size {}".format(r.archive_file(archive_index), offset, size))
+        my_crc = crc32(r.read(path)) & 0xFFFFFFFF
+        print("CRC {} = {}, {}".format(my_crc, crc, my_crc == crc))
+    r.close()
+
+buffers = local()
+
+def read_buffer():
+    # one buffer per thread, reused for every file
+    if not hasattr(buffers, "buffer"):
+        buffers.buffer = bytearray(2**20)
+    return buffers.buffer
+
+def file_hashes(path):
+    # size, crc and strong digest, in one pass over the file
+    buffer = read_buffer()
+    view = memoryview(buffer)
+    crc = 0
+    size = 0
+    h = blake2b(digest_size=32)
+    with open(path, "rb", buffering=0) as t:
+        while True:
+            n = t.readinto(buffer)
+            if n == 0:
+                break
+            crc = crc32(view[:n], crc)
+            h.update(view[:n])
+            size += n
+    return size, crc, h.digest()
+
+class HashIndex(object):
+    # hashes of the packed files and where their payloads went, kept next to the archives
+    def __init__(self, index_file):
+        self.index_file = index_file
+        # path -> (size, modification time, crc, digest)
+        # digest -> (archive index, offset, size, crc)
+        self.files, self.payloads = atomic_load(index_file, ({}, {}))
+
+    def save(self):
+        atomic_write(self.index_file, marshal_dumps((self.files, self.payloads)))
+
+def append_file(s, path, size):
+    buffer = read_buffer()
+    view = memoryview(buffer)
+    n = 0
+    with open(path, "rb", buffering=0) as t:
+        while True:
+            k = t.readinto(buffer)
+            if k == 0:
+                break
+            s.write(view[:k])
+            n += k
+    assert n == size, "{} changed while packing".format(path)
+
+class ArchiveWriter(object):
+    # appends payloads to numbered archive files, starting a new one after max_o bytes
+    def __init__(self, prefix, i, max_o):
+        self.prefix = prefix
+        self.i = i
+        self.max_o = max_o
+        self.s = None
+
+    def append(self, path, size):
+        if self.s is None:
+            self.s = open("{}_{:03}.vpk".format(self.prefix, self.i), "wb")
+        elif self.s.tell() > self.max_o:
+            self.s.close()
+            self.i += 1
+            self.s = open("{}_{:03}.vpk".format(self.prefix, self.i), "wb")
+        o = self.s.tell()
+        append_file(self.s, path, size)
+        return self.i, o
+
+    def close(self):
+        if self.s is not None:
+            self.s.close()
+
+def create_vpk(prefix, pack_dir, max_o=2**20 * 100, threads=8, update=False):
+    # with update, payloads that are already in the archives stay where they are,
+    # the rest goes to new archives and only the directory is written again
     filelist = []
     for (p, ds, fs) in walk(pack_dir):
         rel_p = canonical_file(relpath(p, pack_dir))
         for f in fs:
             filelist.append((rel_p, canonical_file(f)))
 
-    file_types = OrderedDict()
-    crc_index = {}
-    i = 0
-    max_o = 2**20 * 100
-    archive_file = "{}_{:03}.vpk".format(prefix, i)
-    s = open(archive_file, "wb")
+    # hardlinked files have the same contents, so they only need to be read once
+    inodes = []
+    first_paths = {}
+    stats = {}
+    for p, f in filelist:
+        st = stat(join(pack_dir, p, f))
+        inode = (st.st_dev, st.st_ino) if st.st_ino != 0 else join(p, f)
+        inodes.append(inode)
+        if inode not in first_paths:
+            first_paths[inode] = join(p, f)
+            stats[inode] = st
+
+    # files that didn't change since the last time aren't hashed again
+    hash_index = HashIndex("{}_hashes".format(prefix))
+    old_files = hash_index.files
+    old_payloads = {}
+    first_archive = 0
+    if update:
+        assert hash_index.payloads, "No hashes of the existing archives, pack them without updating first"
+        with open("{}_dir.vpk".format(prefix), "rb") as s:
+            data_offset, old_entries = read_directory(s)
+        # only payloads the directory still refers to are kept
+        locations = set((i, o, size, crc) for extension, directory, filename, crc, i, o, size, preload in old_entries)
+        old_payloads = dict((digest, location) for digest, location in hash_index.payloads.items() if location in locations)
+        first_archive = max([i + 1 for i, o, size, crc in locations] or [0])
+    hash_index.files = {}
+    hash_index.payloads = {}
+
+    entries = []
+    digest_index = {}
+    inode_index = {}
+    writer = ArchiveWriter(prefix, first_archive, max_o)
     try:
-        for p, f in filelist:
-            o = s.tell()
-            if o > max_o:
-                s.close()
-                i += 1
-                archive_file = "{}_{:03}.vpk".format(prefix, i)
-                s = open(archive_file, "wb")
-                o = 0
-
-            with open(join(pack_dir, p, f), "rb") as t:
-                d = t.read()
-            size = len(d)
-            crc = crc32(d)
-            name, extension = f.rsplit(".", 1)
-            if (crc, size) in crc_index:
-                # TODO: actually check equality in case of CRC+size collisions!
-                our_i, our_o = crc_index[(crc, size)]
-            else:
-                crc_index[(crc, size)] = (i, o)
-                s.write(d)
-                our_i = i
-                our_o = o
-            file_types.setdefault(extension, OrderedDict()).setdefault(p, []).append((name, our_i, our_o, size, crc))
+        # files are hashed in the pool while this thread appends them to the archive in order
+        with ThreadPoolExecutor(threads) as executor:
+            known = {}
+            futures = {}
+            for inode, path in first_paths.items():
+                entry = old_files.get(path)
+                st = stats[inode]
+                if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                    known[inode] = (entry[0], entry[2], entry[3])
+                else:
+                    futures[inode] = executor.submit(file_hashes, join(pack_dir, path))
+            for inode, path in first_paths.items():
+                if inode in known:
+                    size, crc, digest = known[inode]
+                else:
+                    size, crc, digest = futures.pop(inode).result()
+                hash_index.files[path] = (size, stats[inode].st_mtime_ns, crc, digest)
+
+                # the same size and digest is the same contents
+                if (size, digest) in digest_index:
+                    our_i, our_o = digest_index[(size, digest)]
+                else:
+                    if digest in old_payloads and old_payloads[digest][2:] == (size, crc):
+                        our_i, our_o, size, crc = old_payloads[digest]
+                    else:
+                        our_i, our_o = writer.append(join(pack_dir, path), size)
+                    digest_index[(size, digest)] = (our_i, our_o)
+                    hash_index.payloads[digest] = (our_i, our_o, size, crc)
+                inode_index[inode] = (our_i, our_o, size, crc)
     finally:
-        s.close()
-
-    types = []
-    for t, ds in file_types.items():
-        dirs = []
-        for d, fs in ds.items():
-            files = []
-            for (name, i, o, size, crc) in fs:
-                files.append({
-                    "filename": name,
-                    "crc": crc,
-                    "preloadsize": 0,
-                    "archive_index": i,
-                    "archive_offset": o,
-                    "archive_size": size,
-                    "preload_data": b"",
-                    })
-            dirs.append({
-                "path": d,
-                "file": files,
-                })
-        types.append({
-            "type": t,
-            "directory": dirs,
-            })
-    v = VPK()
-    v.data = {
-        "version": 1,
-        "index_size": 0,
-        "index": types,
-        }
+        writer.close()
+
+    for (p, f), inode in zip(filelist, inodes):
+        name, extension = f.rsplit(".", 1)
+        our_i, our_o, size, crc = inode_index[inode]
+        entries.append((extension, p, name, crc, our_i, our_o, size, b""))
+
     with open("{}_dir.vpk".format(prefix), "wb") as s:
-        v.pack(s)
+        write_directory(s, entries)
+    hash_index.save()
 
 if __name__ == "__main__":
     if argv[1] == "t": # test
@@ -118,7 +184,11 @@ if __name__ == "__main__":
         with open(argv[2], "rb") as s:
             v.unpack(s)
         print(dumps(v.serialize(), indent=4))
-    elif argv[1] == "a": # create a vpk file
-        create_vpk(argv[2], argv[3])
+    elif argv[1] in ["a", "u"]: # create a vpk file, or update one
+        if len(argv) > 4:
+            # maximum archive size in MiB
+            create_vpk(argv[2], argv[3], int(argv[4]) * 2**20, update=argv[1] == "u")
+        else:
+            create_vpk(argv[2], argv[3], update=argv[1] == "u")
     else:
         assert False, "wrong command line options"
@@ -1,5 +1,13 @@
 from binary import Struct, Magic, Format, BaseArray, String, Blob, FakeWriteStream
+from fileindex import canonical_file
+from collections import OrderedDict
 from itertools import count
+from mmap import mmap, ACCESS_READ
+from os import makedirs, replace, stat, getpid
+from os.path import dirname
+from struct import Struct as StructFormat, pack, unpack
+from threading import Lock, get_ident
+from zlib import crc32
 
 class VPK(Struct):
     def fields(self):
@@ -64,3 +72,157 @@ class File(Struct):
 
     def should_serialize(self, k, f):
         return k not in ["terminator", "preload_data"]
+
+# crc, preload size, archive index, offset, size and terminator of a directory entry
+entry_format = StructFormat("<IHHIIH")
+
+def read_directory(s):
+    # where the data in the directory file starts and
+    # [(extension, directory, filename, crc, archive index, offset, size, preload data)],
+    # decoded from one buffer instead of a field object per value
+    magic, version, index_size = unpack("<4sII", s.read(12))
+    assert magic == b"\x34\x12\xaa\x55", magic
+    assert version in [1, 2], version
+    header_size = 12
+    if version == 2:
+        # the game archives also have the sizes of the file data, archive md5, other md5 and signature sections
+        s.read(16)
+        header_size = 28
+    data = s.read(index_size)
+    assert len(data) == index_size, "Unexpected EOF"
+    find = data.index
+    unpack_entry = entry_format.unpack_from
+    entry_size = entry_format.size
+    entries = []
+    pos = 0
+    while True:
+        end = find(b"\0", pos)
+        extension = data[pos:end].decode()
+        pos = end + 1
+        if extension == "":
+            break
+        while True:
+            end = find(b"\0", pos)
+            directory = data[pos:end].decode()
+            pos = end + 1
+            if directory == "":
+                break
+            while True:
+                end = find(b"\0", pos)
+                filename = data[pos:end].decode()
+                pos = end + 1
+                if filename == "":
+                    break
+                crc, preload_size, archive_index, offset, size, terminator = unpack_entry(data, pos)
+                assert terminator == 0xFFFF, terminator
+                pos += entry_size
+                preload = data[pos:pos + preload_size]
+                pos += preload_size
+                entries.append((extension, directory, filename, crc, archive_index, offset, size, preload))
+    return header_size + index_size, entries
+
+def write_directory(s, entries):
+    # entries as returned by read_directory, grouped by extension and directory in order of first appearance
+    tree = OrderedDict()
+    for entry in entries:
+        tree.setdefault(entry[0], OrderedDict()).setdefault(entry[1], []).append(entry)
+    l = []
+    for extension, directories in tree.items():
+        l.append(extension.encode() + b"\0")
+        for directory, files in directories.items():
+            l.append(directory.encode() + b"\0")
+            for extension, directory, filename, crc, archive_index, offset, size, preload in files:
+                l.append(filename.encode() + b"\0")
+                l.append(entry_format.pack(crc, len(preload), archive_index, offset, size, 0xFFFF))
+                l.append(preload)
+            l.append(b"\0")
+        l.append(b"\0")
+    l.append(b"\0")
+    index = b"".join(l)
+    s.write(pack("<4sII", b"\x34\x12\xaa\x55", 1, len(index)))
+    s.write(index)
+
+def entry_path(directory, filename, extension):
+    # the root directory and files without an extension are stored as " "
+    path = filename if extension == " " else "{}.{}".format(filename, extension)
+    if directory != " ":
+        path = "{}/{}".format(directory, path)
+    return path.lower().replace("\\", "/")
+
+class VPKReader(object):
+    # reads files from a VPK archive set without unpacking it, the directory is only decoded once
+    def __init__(self, dir_file, max_open=16):
+        assert dir_file.endswith("_dir.vpk"), dir_file
+        self.prefix = dir_file[0:-len("_dir.vpk")]
+        self.max_open = max_open
+        with open(dir_file, "rb") as s:
+            # data in the directory file itself comes after the directory
+            self.dir_offset, entries = read_directory(s)
+        # canonical path -> (archive index, offset, size, crc, preload data)
+        self.entries = {}
+        for extension, directory, filename, crc, archive_index, offset, size, preload in entries:
+            self.entries[entry_path(directory, filename, extension)] = (archive_index, offset, size, crc, preload)
+        # archive index -> (file, mmap), the least recently used is closed first
+        self.archives = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, path):
+        return canonical_file(path) in self.entries
+
+    def archive_file(self, archive_index):
+        if archive_index == 0x7FFF:
+            return "{}_dir.vpk".format(self.prefix)
+        return "{}_{:03}.vpk".format(self.prefix, archive_index)
+
+    def archive(self, archive_index):
+        # called with the lock held
+        if archive_index in self.archives:
+            self.archives.move_to_end(archive_index)
+            return self.archives[archive_index][1]
+        s = open(self.archive_file(archive_index), "rb")
+        m = mmap(s.fileno(), 0, access=ACCESS_READ)
+        self.archives[archive_index] = (s, m)
+        while len(self.archives) > self.max_open:
+            old_index, (old_s, old_m) = self.archives.popitem(last=False)
+            old_m.close()
+            old_s.close()
+        return m
+
+    def read(self, path):
+        archive_index, offset, size, crc, preload = self.entries[canonical_file(path)]
+        if size == 0:
+            return preload
+        if archive_index == 0x7FFF:
+            offset += self.dir_offset
+        with self.lock:
+            d = self.archive(archive_index)[offset:offset + size]
+        assert len(d) == size, "{} is truncated".format(path)
+        return preload + d
+
+    def check(self, path):
+        # whether the contents of path match its crc
+        crc = self.entries[canonical_file(path)][3]
+        return crc32(self.read(path)) & 0xFFFFFFFF == crc
+
+    def extract(self, path, dest):
+        # write path to dest, unless dest already has the same contents
+        archive_index, offset, size, crc, preload = self.entries[canonical_file(path)]
+        try:
+            if stat(dest).st_size == len(preload) + size:
+                with open(dest, "rb") as s:
+                    if crc32(s.read()) & 0xFFFFFFFF == crc:
+                        return
+        except FileNotFoundError:
+            pass
+        makedirs(dirname(dest), exist_ok=True)
+        tmp = "{}.{}.{}.tmp".format(dest, getpid(), get_ident())
+        with open(tmp, "wb") as s:
+            s.write(self.read(path))
+        replace(tmp, dest)
+
+    def close(self):
+        with self.lock:
+            for s, m in self.archives.values():
+                m.close()
+                s.close()
+            self.archives.clear()